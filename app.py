@@ -8,7 +8,7 @@ import tempfile
 from flask_compress import Compress
 from werkzeug.exceptions import HTTPException
 from werkzeug.middleware.proxy_fix import ProxyFix
-from flask import Flask, Response, jsonify, request, session, send_file, render_template, after_this_request
+from flask import Flask, Response, jsonify, request, session, render_template
 
 from app_version import __version__
 
@@ -18,9 +18,10 @@ from tools.http import handle_413
 from tools.system import ffmpeg_ok
 from tools.limits import RateLimiter
 from tools.api_auth import IPGeoTokenManager
-from tools.validation import validate_merge_request
+from tools.stream_parser import parse_into_request
+from tools.validation import max_request_bytes, validate_merge_request
 from tools.security import ensure_csrf, auth_bearer_or_same_origin_csrf
-from tools.utils import create_zip, saving_files, check_files_are_mp3, smart_merge_mp3_files
+from tools.utils import stream_zip, saving_files, upload_params, iter_smart_merge, check_files_are_mp3
 
 app = Flask(__name__)
 Compress(app)
@@ -29,7 +30,11 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
 # ---- Config / constants ----
 MAX_FILES = int(os.getenv("MAX_FILES", "50"))
 MAX_PER_FILE_MB = int(os.getenv("MAX_PER_FILE_MB", "50"))
-MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", str(100 * 1024 * 1024)))
+# Больше, чем MAX_FILES файлов по MAX_PER_FILE_MB, всё равно не пройдёт валидацию — такие запросы
+# werkzeug отклоняет с 413 по Content-Length, ещё до чтения тела.
+MAX_CONTENT_LENGTH = min(
+    int(os.getenv("MAX_CONTENT_LENGTH", str(100 * 1024 * 1024))), max_request_bytes(MAX_FILES, MAX_PER_FILE_MB)
+)
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
 TOKEN_FILE_PATH = os.getenv("TOKEN_FILE_PATH", "tokens/allowed_tokens.txt")
@@ -67,6 +72,18 @@ def handle_errors(exc):
     return jsonify({"error": "Internal server error"}), 500
 
 
+# ---- Request hooks ----
+@app.before_request
+def stream_merge_upload():
+    """
+    Тело POST /merge разбираем потоково (streaming-form-data) ещё до CSRF-проверки, которая читает форму.
+    Слишком большие файлы при этом не сохраняются целиком, а больше MAX_FILES + 1 файлов — 413;
+    без пакета тело разбирает werkzeug.
+    """
+    if request.endpoint == "merge_files" and request.mimetype == "multipart/form-data":
+        parse_into_request(request, "files", MAX_PER_FILE_MB << 20, MAX_FILES)
+
+
 # ---- Routes ----
 @app.route("/healthz", methods=["GET"])
 def healthz():
@@ -127,6 +144,7 @@ def merge_files():  # pylint: disable=too-many-locals
         return error_resp, error_code
 
     ip_addr = request.remote_addr or "unknown"
+    upload_folder = merged_folder = None
 
     try:
         upload_folder = tempfile.mkdtemp(prefix="mp3_up_")
@@ -134,15 +152,11 @@ def merge_files():  # pylint: disable=too-many-locals
 
         file_paths = saving_files(upload_folder, files)
 
-        max_bytes = MAX_PER_FILE_MB * 1024 * 1024
-        for p in file_paths:
-            if os.path.getsize(p) > max_bytes:
-                shutil.rmtree(upload_folder, ignore_errors=True)
-                shutil.rmtree(merged_folder, ignore_errors=True)
-                return jsonify({"error": f"File too large: {os.path.basename(p)} (> {MAX_PER_FILE_MB} MB)"}), 400
-
-        merged_files = smart_merge_mp3_files(file_paths, count, merged_folder=merged_folder)
-        archive_path = create_zip(merged_folder, merged_files)
+        merged = iter_smart_merge(file_paths, count, merged_folder, params=upload_params(files))
+        chunks = stream_zip(merged, remove_after=True)
+        # Первая группа склеивается здесь: ошибки merge ещё можно вернуть как JSON 500,
+        # остальные группы доклеиваются, пока клиент уже качает архив.
+        first_chunk = next(chunks)
 
         duration = round(time.time() - start_time, 3)
         app_logger.info("Files merged successfully in %ss", duration)
@@ -160,18 +174,28 @@ def merge_files():  # pylint: disable=too-many-locals
                 },
             )
 
-        @after_this_request
-        def cleanup(response: Response):
+        def body():
+            yield first_chunk
+            yield from chunks
+
+        def cleanup():
+            # Если клиент отключился до конца архива, закрываем конвейер: отменяем оставшиеся склейки
+            # и ждём уже запущенные ffmpeg, чтобы они не писали в удаляемые папки.
+            chunks.close()
             for path in (upload_folder, merged_folder):
                 try:
                     shutil.rmtree(path)
                 except OSError as e:
                     app_logger.error("Error cleaning temp dir %s: %s", path, e)
-            response.headers["X-Process-Time"] = str(duration)
-            response.headers["Cache-Control"] = "no-store"
-            return response
 
-        return send_file(archive_path, as_attachment=True, download_name="merged_files.zip", mimetype="application/zip")
+        response = Response(body(), mimetype="application/zip")
+        response.headers["Content-Disposition"] = "attachment; filename=merged_files.zip"
+        # Время до готовности первой группы: остальные склеиваются, пока клиент качает архив.
+        response.headers["X-Process-Time"] = str(duration)
+        response.headers["Cache-Control"] = "no-store"
+        # Временные папки нужны, пока архив отдаётся клиенту — чистим их после закрытия ответа.
+        response.call_on_close(cleanup)
+        return response
 
     except Exception as err:
         app_logger.error("Error during merging files: %s", err)
@@ -180,6 +204,10 @@ def merge_files():  # pylint: disable=too-many-locals
                 "MP3 merge fail",
                 extra={"extra": {"ip": ip_addr, "files": len(files), "status": "fail", "reason": str(err)}},
             )
+        # Ответ с архивом не создан — временные папки больше никому не нужны.
+        for path in (upload_folder, merged_folder):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
         return jsonify({"error": "Internal server error"}), 500
 
 
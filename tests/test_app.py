@@ -5,6 +5,7 @@ import os
 import zipfile
 from unittest.mock import patch
 
+import pytest
 from werkzeug.datastructures import FileStorage
 
 import app as app_module
@@ -92,25 +93,16 @@ def test_merge_happy_path_minimal_pipeline(client, tmp_path):  # pylint: disable
             None,
         )
 
-    def fake_merge(_file_paths, _count, merged_folder):
-        """Мокаем smart_merge_mp3_files: создаем один «мерджнутый» mp3."""
+    def fake_merge(_file_paths, _count, merged_folder, **_kwargs):
+        """Мокаем iter_smart_merge: отдаем один «мерджнутый» mp3."""
         out1 = os.path.join(merged_folder, "merged_1.mp3")
         with open(out1, "wb") as f:
             f.write(b"merged")
-        return [out1]
-
-    def fake_zip(merged_folder, merged_files):
-        """Мокаем create_zip: создаем реальный zip с переданными файлами."""
-        zip_path = os.path.join(merged_folder, "merged_files.zip")
-        with zipfile.ZipFile(zip_path, "w") as z:
-            for p in merged_files:
-                z.write(p, arcname=os.path.basename(p))
-        return zip_path
+        yield out1
 
     with (
         patch("app.validate_merge_request", side_effect=fake_validate),
-        patch("app.smart_merge_mp3_files", side_effect=fake_merge),
-        patch("app.create_zip", side_effect=fake_zip),
+        patch("app.iter_smart_merge", side_effect=fake_merge),
     ):
         data = {
             "count": "2",
@@ -130,7 +122,58 @@ def test_merge_happy_path_minimal_pipeline(client, tmp_path):  # pylint: disable
         assert resp.status_code == 200
         assert resp.headers.get("Content-Type", "").startswith("application/zip")
         assert resp.headers.get("X-Process-Time") is not None
-        assert len(resp.data) > 0
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as z:
+            assert z.read("merged_1.mp3") == b"merged"
+
+
+def test_merge_500_when_normalization_fails(client, tmp_path):
+    """Один файл не нормализовался → 500 JSON, а не 200 ZIP с группой без этого трека; временные папки удалены."""
+    with client.session_transaction() as sess:
+        sess["csrf_token"] = "test-csrf"
+
+    def fake_validate(req, *_args) -> tuple:
+        """Мокаем validate_merge_request: отдаем загруженные файлы без разобранных параметров."""
+        return req.files.getlist("files"), 2, None, None
+
+    def fake_mkdtemp(prefix):
+        """Временные папки создаём внутри tmp_path, чтобы проверить их удаление."""
+        path = tmp_path / prefix
+        path.mkdir()
+        return str(path)
+
+    with (
+        patch("app.validate_merge_request", side_effect=fake_validate),
+        patch("tools.utils.Merge.all_params_equal", return_value=False),
+        patch("tools.utils.Merge.normalize_mp3_file_parallel", side_effect=lambda paths, _folder: [paths[0], None]),
+        patch("tools.utils.Merge.iter_mp3_groups_ffmpeg") as concat,
+        patch("app.tempfile.mkdtemp", side_effect=fake_mkdtemp) as mkdtemp,
+    ):
+        data = {
+            "count": "2",
+            "csrf_token": "test-csrf",
+            "files": [(io.BytesIO(b"a"), "1.mp3", "audio/mpeg"), (io.BytesIO(b"b"), "2.mp3", "audio/mpeg")],
+        }
+        resp = client.post("/merge", data=data, headers=_origin_headers())
+
+    assert resp.status_code == 500
+    assert resp.get_json()["error"] == "Internal server error"
+    concat.assert_not_called()
+    assert mkdtemp.call_count == 2
+    assert not os.listdir(tmp_path)
+
+
+def test_merge_413_too_many_file_parts(client):
+    """POST /merge с частями файлов сверх MAX_FILES + 1 → 413 ещё до CSRF-проверки и валидации."""
+    pytest.importorskip("streaming_form_data")
+    data = {
+        "count": "1",
+        "files": [(io.BytesIO(b"x"), f"{i}.mp3", "audio/mpeg") for i in range(app_module.MAX_FILES + 2)],
+    }
+    with patch("app.validate_merge_request") as validate:
+        resp = client.post("/merge", data=data, headers=_origin_headers())
+    assert resp.status_code == 413
+    assert "too large" in resp.get_json()["error"]
+    validate.assert_not_called()
 
 
 def test_merge_413_error_handler():
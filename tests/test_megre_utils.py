@@ -2,8 +2,9 @@
 
 Покрываются:
 - нормализация имён файлов;
+- чтение параметров MP3 по заголовку фрейма;
 - проверка all_params_equal;
-- байтовый merge в группах;
+- разбиение на группы и копирование потоков;
 - нормализация MP3 через ffmpeg (моки);
 - объединение MP3 через ffmpeg concat (моки).
 """
@@ -11,7 +12,9 @@
 from __future__ import annotations
 
 import os
+import threading
 from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -36,6 +39,58 @@ def test_normalize_filename(raw: str, expected: str) -> None:
     assert Merge.normalize_filename(raw) == expected
 
 
+# ---------- _get_mp3_params ----------
+
+
+def test_get_mp3_params_after_id3(tmp_path) -> None:
+    """ID3v2-тег пропускается, параметры читаются из первого MPEG-фрейма."""
+    p = tmp_path / "a.mp3"
+    # ID3v2 c телом 5 байт, затем MPEG1 Layer III 128 kbps 44100 Hz stereo
+    p.write_bytes(b"ID3\x03\x00\x00\x00\x00\x00\x05" + b"\x00" * 5 + b"\xff\xfb\x90\x00" + b"\x00" * 64)
+    assert Merge._get_mp3_params(str(p)) == (128000, 44100, 2, 3)  # pylint: disable=protected-access
+
+
+def test_get_mp3_params_mono_mpeg2(tmp_path) -> None:
+    """MPEG2 Layer III 64 kbps 22050 Hz mono без ID3."""
+    p = tmp_path / "m.mp3"
+    p.write_bytes(b"\xff\xf3\x80\xc0" + b"\x00" * 64)
+    assert Merge._get_mp3_params(str(p)) == (64000, 22050, 1, 3)  # pylint: disable=protected-access
+
+
+def test_get_mp3_params_invalid(tmp_path) -> None:
+    """Нет валидного заголовка фрейма → (None, None, None, None)."""
+    p = tmp_path / "bad.mp3"
+    p.write_bytes(b"not an mp3 at all")
+    assert Merge._get_mp3_params(str(p)) == (None, None, None, None)  # pylint: disable=protected-access
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (b"ID3\x04\x00\x00\x00\x00\x00\x00", 10),
+        (b"ID3\x04\x00\x00\x7f\x7f\x7f\x7f", 10 + 0x0FFFFFFF),
+        (b"ID3\x04\x00\x00\x00\x00\x02\x01", 10 + 257),
+        (b"ID3\x04\x00\x10\x00\x00\x00\x05", 10 + 5 + 10),
+        (b"\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00", 0),
+        (b"ID3", 0),
+    ],
+)
+def test_get_id3v2_size(header: bytes, expected: int) -> None:
+    """Synchsafe-размер тега (+ футер по флагу) складывается из 7-битных групп."""
+    assert Merge.get_id3v2_size(header) == expected
+
+
+def test_get_mp3_params_cache_invalidated_on_change(tmp_path) -> None:
+    """Повторный вызов берётся из кэша, изменение файла даёт новые параметры."""
+    p = tmp_path / "c.mp3"
+    p.write_bytes(b"\xff\xfb\x90\x00" + b"\x00" * 64)
+    assert Merge._get_mp3_params(str(p)) == (128000, 44100, 2, 3)  # pylint: disable=protected-access
+    assert Merge._get_mp3_params(str(p)) == (128000, 44100, 2, 3)  # pylint: disable=protected-access
+
+    p.write_bytes(b"\xff\xfb\x90\xc0" + b"\x00" * 128)
+    assert Merge._get_mp3_params(str(p)) == (128000, 44100, 1, 3)  # pylint: disable=protected-access
+
+
 # ---------- all_params_equal ----------
 
 
@@ -46,7 +101,7 @@ def test_all_params_equal_true(monkeypatch: pytest.MonkeyPatch, tmp_path) -> Non
         with open(p, "wb"):
             pass
 
-    monkeypatch.setattr(Merge, "_get_mp3_params", lambda _: (192000, 44100, 2))
+    monkeypatch.setattr(Merge, "_get_mp3_params", lambda _: (192000, 44100, 2, 3))
     assert Merge.all_params_equal(files) is True
 
 
@@ -57,7 +112,7 @@ def test_all_params_equal_false(monkeypatch: pytest.MonkeyPatch, tmp_path) -> No
         with open(p, "wb"):
             pass
 
-    params = [(192000, 44100, 2), (128000, 44100, 2), (192000, 48000, 2)]
+    params = [(192000, 44100, 2, 3), (128000, 44100, 2, 3), (192000, 48000, 2, 3)]
 
     def fake_get(path: str):
         i = int(os.path.basename(path)[1])  # f0/f1/f2
@@ -67,50 +122,52 @@ def test_all_params_equal_false(monkeypatch: pytest.MonkeyPatch, tmp_path) -> No
     assert Merge.all_params_equal(files) is False
 
 
-# ---------- merge_files_in_groups ----------
+def test_all_params_equal_empty() -> None:
+    """Пустой список файлов считается однородным."""
+    assert Merge.all_params_equal([]) is True
 
 
-def test_merge_files_in_groups_basic(tmp_path) -> None:
-    """Байтовый merge по группам: 5 входов → 3 выхода, проверяем содержимое."""
-    inputs = []
-    for i in range(5):
-        p = tmp_path / f"in{i}.mp3"
-        with open(p, "wb") as f:
-            f.write(f"FILE{i}-".encode())
-        inputs.append(str(p))
+# ---------- split_groups / copy_stream ----------
 
-    out_dir = tmp_path / "out"
-    merged = Merge.merge_files_in_groups(inputs, group_size=2, output_folder=str(out_dir))
-    assert len(merged) == 3
-    assert [os.path.basename(m) for m in merged] == [
-        "merged_1.mp3",
-        "merged_2.mp3",
-        "merged_3.mp3",
-    ]
-
-    with open(merged[0], "rb") as f:
-        assert f.read() == b"FILE0-FILE1-"
-    with open(merged[1], "rb") as f:
-        assert f.read() == b"FILE2-FILE3-"
-    with open(merged[2], "rb") as f:
-        assert f.read() == b"FILE4-"
-
-
-def test_merge_files_in_groups_skips_missing(tmp_path) -> None:
-    """Отсутствующий файл пропускается, но merge продолжается."""
-    p1 = tmp_path / "a.mp3"
-    p1.write_bytes(b"A-")
-    missing = tmp_path / "missing.mp3"
-    out_dir = tmp_path / "out"
-    merged = Merge.merge_files_in_groups([str(p1), str(missing)], 2, str(out_dir))
-    assert len(merged) == 1
-    with open(merged[0], "rb") as f:
-        assert f.read() == b"A-"
+
+def test_split_groups_keeps_boundaries() -> None:
+    """Группы по group_size, последняя короче; пути с пробелами целы."""
+    files = ["a b.mp3", "b.mp3", "c.mp3", "d.mp3", "e.mp3"]
+    assert Merge.split_groups(files, 2) == [["a b.mp3", "b.mp3"], ["c.mp3", "d.mp3"], ["e.mp3"]]
+    assert not Merge.split_groups([], 3)
+
+
+def test_copy_stream_falls_back_when_sendfile_fails(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    """sendfile недоступен для пары дескрипторов → данные копируются через copyfileobj с текущей позиции."""
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"skip-PAYLOAD")
+
+    def no_sendfile(*_):
+        raise OSError("sendfile is not supported")
+
+    monkeypatch.setattr(os, "sendfile", no_sendfile, raising=False)
+    with open(src, "rb") as in_f, open(tmp_path / "dst.bin", "wb") as out_f:
+        in_f.seek(5)
+        Merge.copy_stream(in_f, out_f, in_f.fileno())
+    assert (tmp_path / "dst.bin").read_bytes() == b"PAYLOAD"
 
 
 # ---------- normalize_mp3_file_parallel ----------
 
 
+def _fake_ffmpeg(returncode: int):
+    """Фейковый subprocess.run: при успехе создаёт выходной .part-файл, как это сделал бы ffmpeg."""
+
+    def run(command, *_, **__):
+        if returncode == 0:
+            part = next(arg for arg in command if str(arg).endswith(".part"))
+            with open(part, "wb") as f:
+                f.write(b"normalized")
+        return SimpleNamespace(returncode=returncode, stderr=b"boom")
+
+    return run
+
+
 def test_normalize_mp3_file_parallel_success(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
     """ffmpeg возвращает 0 → все файлы нормализуются успешно."""
     inp = []
@@ -119,13 +176,14 @@ def test_normalize_mp3_file_parallel_success(monkeypatch: pytest.MonkeyPatch, tm
         p.write_bytes(b"ID3....")
         inp.append(str(p))
 
-    monkeypatch.setattr("subprocess.run", lambda *_, **__: SimpleNamespace(returncode=0, stderr=b""))
+    monkeypatch.setattr("subprocess.run", _fake_ffmpeg(0))
 
     out_dir = tmp_path / "norm"
     res = Merge.normalize_mp3_file_parallel(inp, str(out_dir))
     assert len(res) == 3
     for i, p in enumerate(res):
         assert p.endswith(f"normalized_in{i}.mp3")
+        assert os.path.isfile(p) and not os.path.exists(f"{p}.part")
 
 
 def test_normalize_mp3_file_parallel_partial_fail(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
@@ -136,11 +194,9 @@ def test_normalize_mp3_file_parallel_partial_fail(monkeypatch: pytest.MonkeyPatc
         p.write_bytes(b"x")
         files.append(str(p))
 
-    calls = {"n": 0}
-
-    def fake_run(*_, **__):
-        calls["n"] += 1
-        return SimpleNamespace(returncode=0 if calls["n"] == 1 else 1, stderr=b"boom")
+    def fake_run(command, *_, **__):
+        failed = command[command.index("-i") + 1].endswith("b.mp3")
+        return _fake_ffmpeg(1 if failed else 0)(command)
 
     monkeypatch.setattr("subprocess.run", fake_run)
     res = Merge.normalize_mp3_file_parallel(files, str(tmp_path / "out"))
@@ -148,6 +204,32 @@ def test_normalize_mp3_file_parallel_partial_fail(monkeypatch: pytest.MonkeyPatc
     assert res[1] is None
 
 
+def test_normalize_mp3_file_parallel_copies_matching_format(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    """Layer III с целевыми частотой и каналами → `-c:a copy`; иначе (и для Layer II) — libmp3lame."""
+    stereo = tmp_path / "stereo.mp3"
+    stereo.write_bytes(b"\xff\xfb\x90\x00" + b"\x00" * 64)
+    mono = tmp_path / "mono.mp3"
+    mono.write_bytes(b"\xff\xfb\x90\xc0" + b"\x00" * 64)
+    layer2 = tmp_path / "layer2.mp3"
+    layer2.write_bytes(b"\xff\xfd\x90\x00" + b"\x00" * 64)  # MPEG1 Layer II, 44100 Hz stereo
+    codecs = {}
+
+    def fake_run(command, *_, **__):
+        src = os.path.basename(command[command.index("-i") + 1])
+        codecs[src] = (command[command.index("-c:a") + 1], threading.current_thread().name.split("_")[0])
+        return _fake_ffmpeg(0)(command)
+
+    monkeypatch.setattr("subprocess.run", fake_run)
+    res = Merge.normalize_mp3_file_parallel([str(stereo), str(mono), str(layer2)], str(tmp_path / "out"))
+    assert all(res)
+    # перепаковка идёт в I/O-пуле, перекодирование — в отдельном CPU-пуле
+    assert codecs == {
+        "stereo.mp3": ("copy", "mp3-io"),
+        "mono.mp3": ("libmp3lame", "mp3-cpu"),
+        "layer2.mp3": ("libmp3lame", "mp3-cpu"),
+    }
+
+
 # ---------- merge_mp3_groups_ffmpeg ----------
 
 
@@ -158,11 +240,23 @@ def test_merge_mp3_groups_ffmpeg_success(monkeypatch: pytest.MonkeyPatch, tmp_pa
         with open(p, "wb"):
             pass
 
-    monkeypatch.setattr("subprocess.run", lambda *_, **__: SimpleNamespace(returncode=0, stderr=b""))
+    lists = {}
+
+    def fake_run(command, *_, **kwargs):
+        # posix_spawn-friendly запуск: без закрытия дескрипторов, бинарник по полному пути (если найден)
+        assert kwargs["close_fds"] is False
+        assert os.path.basename(command[0]) == "ffmpeg"
+        lists[os.path.basename(command[-1])] = kwargs["input"].decode()
+        return SimpleNamespace(returncode=0, stderr=b"")
+
+    monkeypatch.setattr("subprocess.run", fake_run)
 
     out_dir = tmp_path / "out"
     res = Merge.merge_mp3_groups_ffmpeg(files, 3, str(out_dir))
     assert [os.path.basename(p) for p in res] == ["merged_1.mp3", "merged_2.mp3"]
+    # список для concat уходит через stdin, временных файлов в out_dir не остаётся
+    assert lists["merged_2.mp3"] == f"file '{files[3]}'\n"
+    assert not os.listdir(out_dir)
 
 
 def test_merge_mp3_groups_ffmpeg_failure(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
@@ -172,12 +266,32 @@ def test_merge_mp3_groups_ffmpeg_failure(monkeypatch: pytest.MonkeyPatch, tmp_pa
         with open(p, "wb"):
             pass
 
-    calls = {"n": 0}
-
-    def fake_run(*_, **__):
-        calls["n"] += 1
-        return SimpleNamespace(returncode=1 if calls["n"] == 1 else 0, stderr=b"bad")
+    def fake_run(command, *_, **__):
+        failed = command[-1].endswith("merged_1.mp3")
+        return SimpleNamespace(returncode=1 if failed else 0, stderr=b"bad")
 
     monkeypatch.setattr("subprocess.run", fake_run)
     res = Merge.merge_mp3_groups_ffmpeg(files, 2, str(tmp_path / "out"))
     assert [os.path.basename(p) for p in res] == ["merged_2.mp3"]
+
+
+def test_iter_mp3_groups_ffmpeg_close_cancels_pending(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    """Генератор закрыт после первой группы → очередные склейки отменяются, запущенная дожидается."""
+    monkeypatch.setattr("tools.merge_utils.IO_POOL", ThreadPoolExecutor(max_workers=1))
+    gate = threading.Event()
+    started, finished = [], []
+
+    def fake_concat(idx, _group, output_path):
+        started.append(idx)
+        if idx == 2:
+            gate.wait(5)
+        finished.append(idx)
+        return output_path
+
+    monkeypatch.setattr(Merge, "_concat_group_ffmpeg", fake_concat)
+    groups = Merge.iter_mp3_groups_ffmpeg([f"{i}.mp3" for i in range(3)], 1, str(tmp_path))
+    assert os.path.basename(next(groups)) == "merged_1.mp3"
+    threading.Timer(0.2, gate.set).start()
+    groups.close()
+    assert finished == [1, 2]
+    assert 3 not in started
@@ -0,0 +1,46 @@
+"""Тесты для tools.mp3_sniff (проверка MP3 по ID3v2-заголовку и первому фрейму)."""
+
+import io
+
+import pytest
+
+from tools.mp3_sniff import is_mp3, sniff_frame
+
+ID3_5 = b"ID3\x03\x00\x00\x00\x00\x00\x05" + b"\x00" * 5
+
+
+@pytest.mark.parametrize(
+    "payload, expected",
+    [
+        (b"\xff\xfb\x90\x00rest", True),
+        (ID3_5 + b"\xff\xfb\x90\x00rest", True),
+        (ID3_5 + b"RIFF", False),
+        (b"\xff\xfb\xf0\x00rest", False),  # битрейт 0b1111 зарезервирован
+        (b"\xff\xfb\x9c\x00rest", False),  # частота 0b11 зарезервирована
+        (b"\xff\xeb\x90\x00rest", False),  # версия MPEG 0b01 зарезервирована
+        (b"", False),
+    ],
+)
+def test_is_mp3(payload: bytes, expected: bool) -> None:
+    """Валидный заголовок фрейма (после необязательного ID3v2) → True, зарезервированные поля → False."""
+    assert is_mp3(io.BytesIO(payload)) is expected
+
+
+def test_sniff_frame_reads_only_headers_and_restores_position() -> None:
+    """Читается только заголовок, а не весь файл; позиция stream'а возвращается на место."""
+
+    class CountingStream(io.BytesIO):
+        """BytesIO, считающий прочитанные байты"""
+
+        read_bytes = 0
+
+        def read(self, size=-1):
+            data = super().read(size)
+            self.read_bytes += len(data)
+            return data
+
+    stream = CountingStream(ID3_5 + b"\xff\xfb\x90\xc0" + b"\x00" * 100_000)
+    stream.seek(7)
+    assert sniff_frame(stream) == (128000, 44100, 1, 3)
+    assert stream.read_bytes <= 14
+    assert stream.tell() == 7
@@ -0,0 +1,34 @@
+"""Тесты для tools.security (декоратор auth_bearer_or_same_origin_csrf)."""
+
+from flask import Flask
+
+from tools.security import auth_bearer_or_same_origin_csrf
+
+
+def _client(allowed_origin: str):
+    """Тестовый клиент приложения с одним защищённым POST /."""
+    app = Flask(__name__)
+    app.secret_key = "test"
+
+    @app.route("/", methods=["POST"])
+    @auth_bearer_or_same_origin_csrf(None, allowed_origin)
+    def protected():
+        return "ok"
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["csrf_token"] = "tok"
+    return client
+
+
+def test_same_origin_without_headers_passes():
+    """Без Origin/Referer и с верным CSRF запрос проходит."""
+    resp = _client("http://localhost").post("/", data={"csrf_token": "tok"})
+    assert resp.status_code == 200
+
+
+def test_unparsable_allowed_origin_fails_closed():
+    """ALLOWED_ORIGIN не разбирается → 401 даже без Origin/Referer и с верным CSRF."""
+    resp = _client("http://[::1").post("/", data={"csrf_token": "tok"})
+    assert resp.status_code == 401
+    assert resp.get_json()["error"] == "Unauthorized"
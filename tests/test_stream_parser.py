@@ -0,0 +1,113 @@
+"""Тесты для tools.stream_parser (потоковый разбор multipart в request.form / request.files)."""
+
+import io
+from unittest.mock import MagicMock
+
+import pytest
+from flask import Flask, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from tools import stream_parser
+
+pytest.importorskip("streaming_form_data")
+
+
+def _request_ctx(data, **kwargs):
+    """Контекст POST-запроса с multipart-телом из data."""
+    return Flask(__name__).test_request_context("/", method="POST", data=data, **kwargs)
+
+
+def test_parse_fills_form_and_files():
+    """Поля формы и все файлы поля files доступны так же, как после werkzeug."""
+    data = {
+        "count": "2",
+        "csrf_token": "tok",
+        "ignored": "x",
+        "files": [(io.BytesIO(b"AAAA"), "a.mp3", "audio/mpeg"), (io.BytesIO(b"BB"), "b.mp3")],
+    }
+    with _request_ctx(data):
+        assert stream_parser.parse_into_request(request, "files", 1024, 10) is True
+        assert request.form.get("count", type=int) == 2
+        assert request.form.get("csrf_token") == "tok"
+        assert "ignored" not in request.form
+        files = request.files.getlist("files")
+        assert [f.filename for f in files] == ["a.mp3", "b.mp3"]
+        assert [f.stream.read() for f in files] == [b"AAAA", b"BB"]
+        assert files[0].content_type == "audio/mpeg"
+
+
+def test_parse_keeps_only_limit_plus_one_byte():
+    """Слишком большой файл не хранится целиком, но его реальный размер виден в content_length."""
+    data = {"count": "1", "files": [(io.BytesIO(b"x" * 5000), "big.mp3")]}
+    with _request_ctx(data):
+        stream_parser.parse_into_request(request, "files", 100, 10)
+        big = request.files["files"]
+        assert big.content_length == 5000
+        assert len(big.stream.read()) == 101
+
+
+def test_parse_broken_body_gives_empty_form():
+    """Битое multipart-тело → пустые form/files, исключение наружу не уходит."""
+    with _request_ctx(b"garbage", content_type="multipart/form-data; boundary=XX"):
+        assert stream_parser.parse_into_request(request, "files", 1024, 10) is True
+        assert not request.form and not request.files
+
+
+def test_parse_skipped_when_form_already_loaded():
+    """Если werkzeug уже разобрал тело, повторно его не читаем."""
+    with _request_ctx({"count": "1"}):
+        assert request.form["count"] == "1"
+        assert stream_parser.parse_into_request(request, "files", 1024, 10) is False
+
+
+def test_parse_rejects_too_many_file_parts():
+    """Частей файлов больше max_files + 1 → 413 сразу, лишние части не сохраняются."""
+    data = {"count": "1", "files": [(io.BytesIO(b"x"), f"{i}.mp3") for i in range(20)]}
+    with _request_ctx(data):
+        with pytest.raises(RequestEntityTooLarge):
+            stream_parser.parse_into_request(request, "files", 1024, 3)
+        assert "files" not in request.__dict__
+
+
+def test_parse_keeps_one_extra_part_for_validation():
+    """Ровно max_files + 1 частей принимаются: ошибку «Too many files» отдаёт валидация."""
+    data = {"count": "1", "files": [(io.BytesIO(b"x"), f"{i}.mp3") for i in range(4)]}
+    with _request_ctx(data):
+        stream_parser.parse_into_request(request, "files", 1024, 3)
+        assert len(request.files.getlist("files")) == 4
+
+
+def test_parse_oversized_body_is_not_reported_as_too_many_parts(monkeypatch):
+    """413 самого stream'а (тело больше MAX_CONTENT_LENGTH) пробрасывается без лога про число частей."""
+    logger = MagicMock()
+    monkeypatch.setattr(stream_parser, "app_logger", logger)
+    app = Flask(__name__)
+    app.config["MAX_CONTENT_LENGTH"] = 100
+    data = {"count": "1", "files": [(io.BytesIO(b"x" * 1000), "a.mp3")]}
+    with app.test_request_context("/", method="POST", data=data), pytest.raises(RequestEntityTooLarge):
+        stream_parser.parse_into_request(request, "files", 1024, 3)
+    logger.warning.assert_not_called()
+
+
+def test_parse_broken_body_closes_accepted_parts(monkeypatch):
+    """Тело оборвалось после целой части файла → уже принятые временные файлы закрываются."""
+    spools = []
+    real_spool = stream_parser.SpooledTemporaryFile
+
+    def tracking_spool(*args, **kwargs):
+        spool = real_spool(*args, **kwargs)
+        spools.append(spool)
+        return spool
+
+    monkeypatch.setattr(stream_parser, "SpooledTemporaryFile", tracking_spool)
+    body = (
+        b"--XX\r\n"
+        b'Content-Disposition: form-data; name="files"; filename="a.mp3"\r\n\r\n'
+        b"AAAA\r\n"
+        b"--XX\r\n"
+        b"Content-Disposition: garbage\r\n\r\n"
+    )
+    with _request_ctx(body, content_type="multipart/form-data; boundary=XX"):
+        stream_parser.parse_into_request(request, "files", 1024, 3)
+        assert not request.files
+    assert spools and all(spool.closed for spool in spools)
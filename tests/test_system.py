@@ -3,14 +3,26 @@
 Проверяем:
 - успешный запуск ffmpeg (returncode == 0);
 - неуспешный запуск (returncode != 0);
-- обработку исключения при вызове subprocess.run.
+- обработку исключения при вызове subprocess.run;
+- отсутствие ffmpeg в PATH и кэширование результата.
 """
 
 from types import SimpleNamespace
 
+import pytest
+
 from tools import system
 
 
+@pytest.fixture(autouse=True)
+def fresh_ffmpeg_cache(monkeypatch):
+    """Сбрасывает кэш ffmpeg_ok и делает вид, что ffmpeg есть в PATH."""
+    monkeypatch.setattr(system.shutil, "which", lambda _: "/usr/bin/ffmpeg")
+    system.ffmpeg_ok.cache_clear()
+    yield
+    system.ffmpeg_ok.cache_clear()
+
+
 def test_ffmpeg_ok_success(monkeypatch):
     """Если subprocess.run возвращает returncode=0 — ffmpeg_ok() -> True."""
 
@@ -39,3 +51,28 @@ def test_ffmpeg_ok_exception(monkeypatch):
 
     monkeypatch.setattr(system.subprocess, "run", fake_run)
     assert system.ffmpeg_ok() is False
+
+
+def test_ffmpeg_ok_not_in_path(monkeypatch):
+    """Если ffmpeg нет в PATH — False без запуска процесса."""
+    monkeypatch.setattr(system.shutil, "which", lambda _: None)
+
+    def fake_run(*_, **__):
+        raise AssertionError("subprocess.run must not be called")
+
+    monkeypatch.setattr(system.subprocess, "run", fake_run)
+    assert system.ffmpeg_ok() is False
+
+
+def test_ffmpeg_ok_cached(monkeypatch):
+    """Повторный вызов не запускает ffmpeg заново."""
+    calls = {"n": 0}
+
+    def fake_run(*_, **__):
+        calls["n"] += 1
+        return SimpleNamespace(returncode=0)
+
+    monkeypatch.setattr(system.subprocess, "run", fake_run)
+    assert system.ffmpeg_ok() is True
+    assert system.ffmpeg_ok() is True
+    assert calls["n"] == 1
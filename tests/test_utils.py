@@ -2,10 +2,11 @@
 
 import io
 import os
+import zlib
 import zipfile
+from tempfile import SpooledTemporaryFile
 
 import pytest
-import mutagen.mp3
 from werkzeug.datastructures import FileStorage
 
 from tools import utils
@@ -19,36 +20,41 @@ def _fs(name: str, payload: bytes = b"ID3\x00\x00\x00aaaa"):
 # ---------- check_files_are_mp3 ----------
 
 
-def test_check_files_are_mp3_ok(monkeypatch):
-    """Все файлы валидные mp3 → ошибок нет и stream остаётся на позиции 0."""
-    monkeypatch.setattr(utils, "MP3", lambda stream: object())
-    files = [_fs("a.mp3"), _fs("b.mp3")]
+def test_check_files_are_mp3_ok():
+    """ID3-тег + фрейм или MPEG sync в начале → ошибок нет и stream остаётся на позиции 0."""
+    with_tag = b"ID3\x03\x00\x00\x00\x00\x00\x04" + b"\x00" * 4 + b"\xff\xfb\x90\x00rest"
+    files = [_fs("a.mp3", payload=with_tag), _fs("b.mp3", payload=b"\xff\xfb\x90\x00rest")]
     assert utils.check_files_are_mp3(files) is None
     for f in files:
         assert f.stream.tell() == 0
 
 
-def test_check_files_are_mp3_header_error(monkeypatch):
-    """HeaderNotFoundError → 400 и имя файла в сообщении."""
+def test_check_files_are_mp3_tag_without_frame():
+    """ID3-тег есть, но за ним нет MPEG-фрейма → 400."""
+    files = [_fs("tag_only.mp3", payload=b"ID3\x03\x00\x00\x00\x00\x00\x04" + b"\x00" * 4 + b"RIFF")]
+    err = utils.check_files_are_mp3(files)
+    assert err[1] == 400
+    assert "tag_only.mp3" in err[0]["error"]
 
-    def boom(_stream):
-        raise mutagen.mp3.HeaderNotFoundError("bad header")
 
-    monkeypatch.setattr(utils, "MP3", boom)
-    files = [_fs("broken.mp3")]
+def test_check_files_are_mp3_header_error():
+    """Нет ни ID3, ни sync-слова → 400 и имя файла в сообщении."""
+    files = [_fs("broken.mp3", payload=b"RIFF....WAVEfmt ")]
     err = utils.check_files_are_mp3(files)
     assert isinstance(err, tuple) and err[1] == 400
     assert "broken.mp3" in err[0]["error"]
 
 
-def test_check_files_are_mp3_generic_error(monkeypatch):
-    """Прочие исключения → 400 и имя файла в сообщении."""
+def test_check_files_are_mp3_generic_error():
+    """Ошибка чтения stream → 400 и имя файла в сообщении."""
+
+    class BrokenStream(io.BytesIO):
+        """stream, падающий на чтении"""
 
-    def boom(_stream):
-        raise RuntimeError("weird")
+        def read(self, *_a, **_k):
+            raise RuntimeError("weird")
 
-    monkeypatch.setattr(utils, "MP3", boom)
-    files = [_fs("bad.mp3")]
+    files = [FileStorage(stream=BrokenStream(b"ID3"), filename="bad.mp3")]
     err = utils.check_files_are_mp3(files)
     assert err[1] == 400
     assert "bad.mp3" in err[0]["error"]
@@ -68,16 +74,61 @@ def test_saving_files_writes_and_uses_normalized_name(tmp_path, monkeypatch):
         assert fh.read() == b"X"
 
 
-def test_saving_files_raises_on_failure(tmp_path, monkeypatch):  # pylint: disable=unused-argument
-    """Ошибка при save() → RuntimeError с именем файла в сообщении."""
+def test_saving_files_keeps_order_and_dedupes_names(tmp_path):
+    """Порядок путей совпадает с порядком загрузок; одинаковые имена не перетирают друг друга."""
+    files = [_fs("a.mp3", payload=b"1"), _fs("b.mp3", payload=b"2"), _fs("a.mp3", payload=b"3")]
+    paths = utils.saving_files(str(tmp_path), files)
+    assert [os.path.basename(p) for p in paths] == ["a.mp3", "b.mp3", "3_a.mp3"]
+    contents = []
+    for p in paths:
+        with open(p, "rb") as fh:
+            contents.append(fh.read())
+    assert contents == [b"1", b"2", b"3"]
+
+
+def test_stream_size_and_disk_fileno(tmp_path):
+    """Размер меряется без сдвига курсора; у SpooledTemporaryFile в памяти нет fd и он не сбрасывается на диск."""
+    with SpooledTemporaryFile(max_size=1024) as spool:
+        spool.write(b"x" * 10)
+        spool.seek(3)
+        assert utils.disk_fileno(spool) is None
+        assert utils.stream_size(spool) == 10
+        assert spool.tell() == 3 and not spool._rolled  # pylint: disable=protected-access
+
+    p = tmp_path / "a.bin"
+    p.write_bytes(b"y" * 2048)
+    with open(p, "rb") as f:
+        f.seek(5)
+        assert utils.disk_fileno(f) == f.fileno()
+        assert utils.stream_size(f) == 2048
+        assert f.tell() == 5
+
+    assert utils.disk_fileno(io.BytesIO(b"z")) is None
+    assert utils.stream_size(io.BytesIO(b"z" * 7)) == 7
+
+
+def test_saving_files_from_disk_stream(tmp_path):
+    """Поток, уже лежащий на диске, копируется целиком с текущей позиции."""
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"ID3" + b"x" * 5000)
+    out_dir = tmp_path / "up"
+    out_dir.mkdir()
+    with open(src, "rb") as fh:
+        paths = utils.saving_files(str(out_dir), [FileStorage(stream=fh, filename="a.mp3")])
+    with open(paths[0], "rb") as fh:
+        assert fh.read() == src.read_bytes()
+
+
+def test_saving_files_raises_on_failure(tmp_path):
+    """Ошибка чтения загрузки → RuntimeError с именем файла в сообщении."""
 
-    class BadFS(FileStorage):
-        """file storage"""
+    class BrokenStream(io.BytesIO):
+        """stream, падающий на чтении"""
 
-        def save(self, dst, *a, **k):  # pylint: disable=unused-argument
+        def read(self, *_a, **_k):
             raise OSError("disk full")
 
-    f = BadFS(stream=io.BytesIO(b"x"), filename="a.mp3")
+    f = FileStorage(stream=BrokenStream(b"x"), filename="a.mp3")
     with pytest.raises(RuntimeError) as exc:
         utils.saving_files(str(tmp_path), [f])
     assert "Ошибка при сохранении a.mp3" in str(exc.value)
@@ -87,27 +138,42 @@ def test_saving_files_raises_on_failure(tmp_path, monkeypatch):  # pylint: disab
 
 
 def test_smart_merge_fast_path(monkeypatch, tmp_path):
-    """Если параметры равны → вызывается быстрый merge_files_in_groups."""
-    files = [str(tmp_path / "1.mp3"), str(tmp_path / "2.mp3")]
-    for p in files:
-        with open(p, "wb"):
-            pass
-
+    """Параметры равны → ffmpeg concat с `-c copy` по исходным файлам, без нормализации."""
+    files = [str(tmp_path / "1.mp3"), str(tmp_path / "2.mp3"), str(tmp_path / "3.mp3")]
     monkeypatch.setattr(utils.Merge, "all_params_equal", lambda _: True)
-    called = {"merge_in_groups": False}
+    monkeypatch.setattr(
+        utils.Merge, "normalize_mp3_file_parallel", lambda *_: pytest.fail("normalization must be skipped")
+    )
+    seen = {}
 
-    def fake_merge(_file_list, _group_size, output_folder):
-        called["merge_in_groups"] = True
-        os.makedirs(output_folder, exist_ok=True)
-        out = os.path.join(output_folder, "merged_1.mp3")
-        with open(out, "wb"):
-            pass
-        return [out]
+    def fake_concat(file_list, group_size, output_folder):
+        seen["args"] = (file_list, group_size)
+        return [os.path.join(output_folder, "merged_1.mp3"), os.path.join(output_folder, "merged_2.mp3")]
 
-    monkeypatch.setattr(utils.Merge, "merge_files_in_groups", fake_merge)
+    monkeypatch.setattr(utils.Merge, "iter_mp3_groups_ffmpeg", fake_concat)
     out = utils.smart_merge_mp3_files(files, 2, str(tmp_path / "out"))
-    assert called["merge_in_groups"] is True
-    assert len(out) == 1 and out[0].endswith("merged_1.mp3")
+    assert seen["args"] == (files, 2)
+    assert [os.path.basename(p) for p in out] == ["merged_1.mp3", "merged_2.mp3"]
+
+
+def test_smart_merge_uses_known_params(monkeypatch, tmp_path):
+    """Параметры из валидации переданы → файлы повторно не читаются."""
+    files = [str(tmp_path / "1.mp3"), str(tmp_path / "2.mp3")]
+    monkeypatch.setattr(utils.Merge, "all_params_equal", lambda _: pytest.fail("params are already known"))
+    monkeypatch.setattr(
+        utils.Merge, "normalize_mp3_file_parallel", lambda *_: pytest.fail("normalization must be skipped")
+    )
+    monkeypatch.setattr(utils.Merge, "iter_mp3_groups_ffmpeg", lambda file_list, *_: iter(file_list))
+    params = [(128000, 44100, 2, 3), (128000, 44100, 2, 3)]
+    assert utils.smart_merge_mp3_files(files, 2, str(tmp_path), params=params) == files
+
+
+def test_check_files_are_mp3_records_params():
+    """check_files_are_mp3 сохраняет параметры первого фрейма, upload_params их отдаёт."""
+    files = [_fs("a.mp3", payload=b"\xff\xfb\x90\x00rest"), _fs("b.mp3", payload=b"\xff\xfb\x90\xc0rest")]
+    assert utils.check_files_are_mp3(files) is None
+    assert utils.upload_params(files) == [(128000, 44100, 2, 3), (128000, 44100, 1, 3)]
+    assert utils.upload_params([_fs("c.mp3")]) is None
 
 
 def test_smart_merge_normalize_then_ffmpeg(monkeypatch, tmp_path):
@@ -132,46 +198,60 @@ def test_smart_merge_normalize_then_ffmpeg(monkeypatch, tmp_path):
             pass
         return [out]
 
-    monkeypatch.setattr(utils.Merge, "merge_mp3_groups_ffmpeg", fake_concat)
+    monkeypatch.setattr(utils.Merge, "iter_mp3_groups_ffmpeg", fake_concat)
 
     out = utils.smart_merge_mp3_files(files, 2, str(tmp_path / "out"))
     assert called["concat"] is True
     assert len(out) == 1 and out[0].endswith("merged_1.mp3")
 
 
-# ---------- create_zip ----------
-
-
-def test_create_zip_ok(tmp_path):
-    """Архив успешно создаётся и содержит файл."""
-    merged_dir = tmp_path / "m"
-    merged_dir.mkdir()
-    f1 = merged_dir / "x.mp3"
-    f1.write_bytes(b"xxx")
-
-    zip_path = utils.create_zip(str(merged_dir), [str(f1)])
-    assert os.path.exists(zip_path)
-    with zipfile.ZipFile(zip_path) as z:
-        assert sorted(z.namelist()) == ["x.mp3"]
-
-
-def test_create_zip_warns_on_missing_but_continues(tmp_path):
-    """Отсутствующий файл логируется, но архив всё равно создаётся."""
-    merged_dir = tmp_path / "m"
-    merged_dir.mkdir()
-    f1 = merged_dir / "x.mp3"
-    f1.write_bytes(b"xxx")
-
-    missing = merged_dir / "absent.mp3"
-    zip_path = utils.create_zip(str(merged_dir), [str(f1), str(missing)])
-    assert os.path.exists(zip_path)
-    with zipfile.ZipFile(zip_path) as z:
-        assert z.namelist() == ["x.mp3"]
-
-
-def test_create_zip_raises_on_empty_list(tmp_path):
-    """Пустой список файлов → RuntimeError."""
-    merged_dir = tmp_path / "m"
-    merged_dir.mkdir()
+def test_smart_merge_fails_when_normalization_fails(monkeypatch, tmp_path):
+    """Файл не нормализовался → RuntimeError до склейки, а не группа без этого файла."""
+    files = [str(tmp_path / "a.mp3"), str(tmp_path / "b.mp3")]
+    monkeypatch.setattr(utils.Merge, "all_params_equal", lambda _: False)
+    monkeypatch.setattr(utils.Merge, "normalize_mp3_file_parallel", lambda *_: ["n1.mp3", None])
+    monkeypatch.setattr(utils.Merge, "iter_mp3_groups_ffmpeg", lambda *_: pytest.fail("must not merge"))
+    with pytest.raises(RuntimeError, match="b.mp3"):
+        utils.smart_merge_mp3_files(files, 2, str(tmp_path / "out"))
+
+
+# ---------- stream_zip ----------
+
+
+def test_stream_zip_streams_groups_in_order(tmp_path):
+    """Архив собирается из порций в памяти; файлы идут по порядку и удаляются при remove_after."""
+    paths = []
+    for i in (1, 2):
+        p = tmp_path / f"merged_{i}.mp3"
+        p.write_bytes(f"group{i}".encode() * 1000)
+        paths.append(str(p))
+
+    data = b"".join(utils.stream_zip(iter(paths), remove_after=True))
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.namelist() == ["merged_1.mp3", "merged_2.mp3"]
+        assert z.read("merged_2.mp3") == b"group2" * 1000
+        assert z.getinfo("merged_1.mp3").compress_type == zipfile.ZIP_STORED
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_stream_zip_handles_empty_and_multichunk_files(tmp_path, monkeypatch):
+    """Пустой файл не ломает mmap, а большой пишется порциями с верным CRC."""
+    monkeypatch.setattr(utils, "COPY_BUFSIZE", 1000)
+    empty = tmp_path / "empty.mp3"
+    empty.write_bytes(b"")
+    big = tmp_path / "big.mp3"
+    payload = bytes(range(256)) * 10
+    big.write_bytes(payload)
+
+    data = b"".join(utils.stream_zip(iter([str(empty), str(big)])))
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.testzip() is None
+        assert z.read("empty.mp3") == b""
+        assert z.read("big.mp3") == payload
+        assert zlib.crc32(payload) == z.getinfo("big.mp3").CRC
+
+
+def test_stream_zip_raises_when_nothing_to_archive():
+    """Пустой список файлов → RuntimeError до отдачи первого байта."""
     with pytest.raises(RuntimeError):
-        utils.create_zip(str(merged_dir), [])
+        next(utils.stream_zip(iter(())))
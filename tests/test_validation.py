@@ -1,19 +1,30 @@
 """Тесты для tools.validation.
 
 Покрываем:
-- приватные проверки (_check_content_type, _check_files_and_count, _check_sizes);
+- приватные проверки (_check_content_type, _check_files_and_count, _file_size, _scan_files);
 - интеграцию validate_merge_request() по основным веткам.
 """
 
 import io
 from io import BytesIO
 from types import SimpleNamespace
+from tempfile import SpooledTemporaryFile
 
 import pytest
-from flask import Flask, request
-from werkzeug.datastructures import FileStorage
-
-from tools.validation import _check_sizes, _check_content_type, _check_files_and_count, validate_merge_request
+from flask import Flask, jsonify, request
+from werkzeug.datastructures import Headers, FileStorage
+
+from tools.validation import (
+    _STATIC_ERROR_BODIES,
+    _file_size,
+    _error_body,
+    _scan_files,
+    _parse_count,
+    _check_content_type,
+    _filter_empty_files,
+    _check_files_and_count,
+    validate_merge_request,
+)
 
 # ---------- helpers ----------
 
@@ -48,6 +59,18 @@ def test__check_content_type_fail():
         assert code == 415
 
 
+@pytest.mark.parametrize("raw,expected", [("3", 3), (" 2 ", 2), ("-1", -1), ("two", None), ("", None), (None, None)])
+def test__parse_count(raw, expected):
+    """count разбирается как int; отсутствующее или нечисловое значение → None."""
+    assert _parse_count(raw) == expected
+
+
+def test__filter_empty_files():
+    """Части без имени или с пустым (из пробелов) именем отбрасываются, порядок сохраняется."""
+    files = [_fs("a.mp3"), FileStorage(stream=BytesIO(b"x"), filename=""), _fs("   "), None, _fs("b.mp3")]
+    assert [f.filename for f in _filter_empty_files(files)] == ["a.mp3", "b.mp3"]
+
+
 @pytest.mark.parametrize(
     "files,count,max_files,expect_msg",
     [
@@ -70,18 +93,75 @@ def test__check_files_and_count_ok():
     assert msg is None and code == 400
 
 
-def test__check_sizes_too_large():
-    """Если есть файл больше лимита — возвращаем 400 и сообщение."""
+def test__file_size_without_stream_uses_content_length():
+    """Без перематываемого stream'а размер берётся из content_length; большой файл отклоняется."""
     f_big = SimpleNamespace(filename="big.mp3", content_length=51 * 1024 * 1024)
-    msg, code = _check_sizes([f_big], 50 * 1024 * 1024)
-    assert "too large" in msg and code == 400
+    assert _file_size(f_big) == 51 * 1024 * 1024
+    assert _scan_files([f_big], 50 * 1024 * 1024) == ("File big.mp3 is too large (> 50 MB)", 400)
+
+
+def test__file_size_measures_stream_despite_content_length():
+    """Заниженный клиентом content_length не помогает пройти лимит: меряется сам stream."""
+    f = FileStorage(
+        stream=BytesIO(b"x" * 2048),
+        filename="liar.mp3",
+        content_type="audio/mpeg",
+        headers=Headers({"Content-Length": "1"}),
+    )
+    assert f.content_length == 1
+    assert _file_size(f) == 2048
+    assert _scan_files([f], 1024) == ("File liar.mp3 is too large (> 0 MB)", 400)
+    assert f.stream.tell() == 0
+
+
+def test__file_size_measures_each_stream_once():
+    """Размер запоминается на FileStorage: повторная проверка не двигает stream."""
+
+    class CountingStream(BytesIO):
+        """BytesIO, считающий вызовы seek"""
+
+        seeks = 0
+
+        def seek(self, *args):
+            CountingStream.seeks += 1
+            return super().seek(*args)
+
+    f = FileStorage(stream=CountingStream(b"x" * 10), filename="a.mp3")
+    assert _scan_files([f], 1024) == (None, None)
+    assert _scan_files([f], 5)[1] == 400
+    assert _file_size(f) == 10
+    assert CountingStream.seeks == 2
+
 
+@pytest.mark.parametrize("rolled", [False, True])
+def test__file_size_spooled_stream_without_seeks(rolled):
+    """SpooledTemporaryFile меряется без перемотки; буфер в памяти не сбрасывается на диск."""
+    spool = SpooledTemporaryFile(max_size=1024)  # pylint: disable=consider-using-with
+    spool.write(b"x" * 2048 if rolled else b"x" * 10)
+    spool.seek(3)
+    f = FileStorage(stream=spool, filename="a.mp3")
+    assert _file_size(f) == (2048 if rolled else 10)
+    assert spool._rolled is rolled  # pylint: disable=protected-access
+    assert spool.tell() == 3
+    spool.close()
 
-def test__check_sizes_ok():
-    """Все файлы не превышают лимит — ошибок нет."""
-    f = _fs("a.mp3")  # helper из фикстур
-    msg, code = _check_sizes([f], 50 * 1024 * 1024)
-    assert msg is None and code is None
+
+@pytest.mark.parametrize(
+    "files,expect",
+    [
+        ([_fs("a.mp3"), _fs("b.wav")], ("File must have .mp3 extension", 400)),
+        ([_fs("a.mp3"), _fs("e.mp3", b"")], ("File e.mp3 is empty", 400)),
+        (
+            [_fs("a.mp3"), _fs("b.mp3", b"x" * 2048), _fs("c.mp3", b"x" * 4096)],
+            ("File b.mp3 is too large (> 0 MB)", 400),
+        ),
+        ([_fs("a.MP3"), _fs("b.mp3")], (None, None)),
+        ([_fs("a.Mp3"), _fs("mp3")], ("File must have .mp3 extension", 400)),
+    ],
+)
+def test__scan_files(files, expect):
+    """Расширение, пустые и большие файлы; при ошибке называется первый виновный файл."""
+    assert _scan_files(files, 1024) == expect
 
 
 # ---------- интеграционные тесты validate_merge_request ----------
@@ -98,6 +178,36 @@ def test_validate_wrong_mimetype():
         assert err.get_json()["error"].startswith("Content-Type")
 
 
+def test_validate_rejects_oversized_body_before_parsing():
+    """Content-Length больше max_files * max_per_file_mb → 413 без разбора тела."""
+    app = Flask(__name__)
+    data = {"count": "1", "files": [_file_part("a.mp3", b"x" * (2 << 20))]}
+    with app.test_request_context("/", method="POST", data=data, content_type="multipart/form-data"):
+        _, _, err, status = validate_merge_request(request, 1, 1, True, lambda _: None)
+        assert status == 413
+        assert err.get_json()["error"] == "Request too large"
+        assert "files" not in request.__dict__
+
+
+def test_validate_error_responses_are_fresh_objects():
+    """Тело ошибки совпадает с jsonify, но каждый запрос получает свой Response."""
+    app = Flask(__name__)
+    with app.test_request_context("/", method="POST", content_type="text/plain"):
+        first = validate_merge_request(request, 5, 50, True, lambda _: None).error_response
+        second = validate_merge_request(request, 5, 50, True, lambda _: None).error_response
+        assert first is not second
+        assert first.mimetype == "application/json"
+        assert first.get_data() == jsonify({"error": "Content-Type must be multipart/form-data"}).get_data()
+
+
+def test__error_body_matches_jsonify():
+    """Заранее сериализованные и собранные на месте тела ошибок совпадают с jsonify."""
+    app = Flask(__name__)
+    with app.app_context():
+        for msg in [*_STATIC_ERROR_BODIES, "File «а б».mp3 is empty"]:
+            assert _error_body(msg) == jsonify({"error": msg}).get_data()
+
+
 def test_validate_no_files():
     """Нет файлов -> 400 No files provided."""
     app = Flask(__name__)
@@ -130,6 +240,8 @@ def test_validate_ffmpeg_unavailable():
         _, _, err, status = validate_merge_request(request, 5, 50, False, lambda _: None)
         assert err is not None and status == 500
         assert "FFmpeg" in err.get_json()["error"]
+        # тело запроса даже не разбиралось
+        assert "files" not in request.__dict__
 
 
 def test_validate_mp3_error_bubbled():
@@ -5,20 +5,24 @@
 - http: HTTP-утилиты и обработчики ошибок
 - limits: rate limiting
 - merge_utils: нормализация/склейка MP3
+- mp3_sniff: проверка MP3 по заголовкам
 - security: CSRF и same-origin
+- stream_parser: потоковый разбор multipart-тела /merge
 - system: проверки окружения (ffmpeg и т.п.)
 - utils: сохранение, архивирование, «умный» merge
 - validation: валидация входящего запроса
 """
 
-from . import http, utils, limits, system, api_auth, security, validation, merge_utils
+from . import http, utils, limits, system, api_auth, security, mp3_sniff, validation, merge_utils, stream_parser
 
 __all__ = [
     "api_auth",
     "http",
     "limits",
     "merge_utils",
+    "mp3_sniff",
     "security",
+    "stream_parser",
     "system",
     "utils",
     "validation",
@@ -1,105 +1,305 @@
 """Модуль для нормализации и объединения MP3-файлов"""
 
 import os
-import re
-import tempfile
+import atexit
+import shutil
+import struct
+import functools
 import subprocess
 import unicodedata
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from mutagen.mp3 import MP3
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 
 from logger.logger import app_logger
 
+# Общий пул потоков для I/O-задач (чтение заголовков, запуск ffmpeg): потоки создаются один раз
+# и переиспользуются между запросами вместо пула на каждый вызов.
+IO_POOL = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 2), thread_name_prefix="mp3-io")
+atexit.register(IO_POOL.shutdown)
+# Отдельный пул для перекодирования: работу делает сам ffmpeg (поток лишь ждёт дочерний процесс без GIL),
+# поэтому хватает потоков. Задач — не больше, чем ядер, и каждому ffmpeg один поток (`-threads 1`),
+# чтобы одновременные энкодеры не делили ядра между собой.
+CPU_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="mp3-cpu")
+atexit.register(CPU_POOL.shutdown)
+
+# Таблицы для разбора 4-байтового заголовка MPEG-фрейма.
+# Ключ битрейтов — (версия MPEG1?, слой); значения в kbps по индексу 0..14.
+_MPEG_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Заголовки разбираем одним big-endian словом: синхрослово — старшие 11 бит,
+# размер ID3v2 — четыре «synchsafe» байта по 7 значащих бит.
+_U32 = struct.Struct(">I")
+_FRAME_SYNC = 0xFFE00000
+_SYNCSAFE_MASK = 0x7F7F7F7F
+# Индекс версии (биты 4-3 второго байта) → частоты дискретизации; 0b01 зарезервирован.
+_MPEG_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),
+    0b10: (22050, 24000, 16000),
+    0b00: (11025, 12000, 8000),
+}
+
+
+class _UnsafeFilenameChars(dict):
+    """
+    Таблица для str.translate(): удаляет всё, кроме букв/цифр, «_», пробельных символов, «.» и «-».
+    Заполняется лениво — по мере встречи новых символов (не больше max_size записей).
+    """
+
+    max_size = 4096
+
+    def __missing__(self, code: int) -> int | None:
+        ch = chr(code)
+        value = code if ch.isalnum() or ch.isspace() or ch in "_.-" else None
+        if len(self) < self.max_size:
+            self[code] = value
+        return value
+
+
+_UNSAFE_FILENAME_CHARS = _UnsafeFilenameChars()
+
+
+@functools.lru_cache(maxsize=1)
+def _ffmpeg_bin() -> str:
+    """Абсолютный путь к ffmpeg из PATH (если не найден — просто «ffmpeg»)."""
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+
+def _run_ffmpeg(args: list, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Запускает ffmpeg с аргументами args, stdout/stderr захватываются.
+    Абсолютный путь к бинарнику и close_fds=False позволяют subprocess запускать процесс через
+    posix_spawn вместо fork() всего процесса приложения. Лишние дескрипторы при этом не утекают:
+    по умолчанию Python создаёт их ненаследуемыми.
+    """
+    return subprocess.run([_ffmpeg_bin(), *args], capture_output=True, check=False, close_fds=False, **kwargs)
+
+
+# Размер порции для copy_stream по умолчанию.
+_COPY_BUFSIZE = 1024 * 1024
+
+# Сколько байт после ID3v2 просматриваем в поисках первого фрейма (паддинг/мусор перед sync).
+_FRAME_SCAN_BYTES = 4096
+
 
 class Merge:
     """
     Класс, предоставляющий статические методы для нормализации и объединения MP3-файлов.
     """
 
+    @staticmethod
+    def get_id3v2_size(header: bytes) -> int:
+        """
+        Возвращает полный размер ID3v2-тега (заголовок + тело + футер) по первым 10 байтам файла.
+        Если тега нет — 0.
+        """
+        if len(header) < 10 or not header.startswith(b"ID3"):
+            return 0
+        word = _U32.unpack_from(header, 6)[0] & _SYNCSAFE_MASK
+        # сдвигаем 7-битные группы вплотную друг к другу
+        size = word & 0x7F | (word >> 1) & 0x3F80 | (word >> 2) & 0x1FC000 | (word >> 3) & 0xFE00000
+        footer = 10 if header[5] & 0x10 else 0
+        return 10 + size + footer
+
+    @staticmethod
+    def parse_frame_header(header: bytes) -> tuple | None:
+        """
+        Разбирает 4-байтовый заголовок MPEG-фрейма.
+        :return: (bitrate, sample_rate, channels, layer) или None, если это не валидный заголовок.
+        """
+        if len(header) < 4:
+            return None
+        word = _U32.unpack_from(header)[0]
+        if word & _FRAME_SYNC != _FRAME_SYNC:
+            return None
+        version = (word >> 19) & 0x03
+        layer = 4 - ((word >> 17) & 0x03)
+        bitrate_idx = (word >> 12) & 0x0F
+        sample_rate_idx = (word >> 10) & 0x03
+        if version == 0b01 or layer == 4 or bitrate_idx in (0, 15) or sample_rate_idx == 3:
+            return None
+        bitrate = _MPEG_BITRATES[(version == 0b11, layer)][bitrate_idx] * 1000
+        sample_rate = _MPEG_SAMPLE_RATES[version][sample_rate_idx]
+        channels = 1 if (word >> 6) & 0x03 == 0b11 else 2
+        return bitrate, sample_rate, channels, layer
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _probe_mp3_params(_stat_key: tuple, file_path: str) -> tuple:
+        """
+        Читает ID3v2-заголовок и первый MPEG-фрейм файла.
+        Результат кэшируется по (st_dev, st_ino, st_mtime_ns, st_size): изменение файла сбрасывает кэш.
+        """
+        with open(file_path, "rb") as f:
+            f.seek(Merge.get_id3v2_size(f.read(10)))
+            window = f.read(_FRAME_SCAN_BYTES)
+        pos = window.find(b"\xff")
+        while pos != -1:
+            params = Merge.parse_frame_header(window[pos : pos + 4])
+            if params:
+                return params
+            pos = window.find(b"\xff", pos + 1)
+        raise ValueError("MPEG frame header not found")
+
     @staticmethod
     def _get_mp3_params(file_path: str) -> tuple:
         """
-        Возвращает параметры MP3-файла (bitrate, sample_rate, channels).
+        Возвращает параметры MP3-файла (bitrate, sample_rate, channels, layer).
+        Читает только ID3v2-заголовок и первый MPEG-фрейм, без полного разбора файла.
         """
         try:
-            audio = MP3(file_path)
-            # Безопасно берем значения, если нет — ставим None
-            bitrate = getattr(audio.info, "bitrate", None)
-            sample_rate = getattr(audio.info, "sample_rate", None)
-            channels = getattr(audio.info, "channels", None)
-            return bitrate, sample_rate, channels
+            st = os.stat(file_path)
+            return Merge._probe_mp3_params((st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size), file_path)
         except Exception as e:
             app_logger.error("Failed to get MP3 params for %s: %s", file_path, e)
-            return None, None, None
+            return None, None, None, None
 
     @staticmethod
     def all_params_equal(files: list) -> bool:
         """
         Проверяет, одинаковы ли параметры у всех файлов.
+        Файлы читаются параллельно; на первом расхождении оставшиеся проверки отменяются.
         """
-        params = [Merge._get_mp3_params(f) for f in files]
-        return all(p == params[0] for p in params)
+        if not files:
+            return True
+        futures = [IO_POOL.submit(Merge._get_mp3_params, f) for f in files]
+        try:
+            first = futures[0].result()
+            return all(future.result() == first for future in futures[1:])
+        finally:
+            for future in futures:
+                future.cancel()
 
     @staticmethod
     def normalize_filename(filename: str) -> str:
         """
         Приводит имя файла к безопасному формату.
+        Один проход translate() вырезает недопустимые символы, второй — схлопывает пробелы/подчёркивания
+        и убирает точки по краям.
         """
-        filename = unicodedata.normalize("NFKC", filename)
-        filename = re.sub(r"[^\w\s.-]", "", filename, flags=re.UNICODE)
-        filename = filename.strip()
-        filename = re.sub(r"\s+", "_", filename)
-        filename = re.sub(r"_+\.", ".", filename)
-        filename = re.sub(r"_+$", "", filename)
-        filename = re.sub(r"^\.+", "", filename)
-        filename = re.sub(r"\.+$", "", filename)
-        filename = re.sub(r"__+", "_", filename)
-        filename = re.sub(r"\.{2,}(\.[A-Za-z0-9]{1,5})$", r"\1", filename)
+        if not filename.isascii():
+            filename = unicodedata.normalize("NFKC", filename)
+        filename = filename.translate(_UNSAFE_FILENAME_CHARS).strip()
+
+        out: list[str] = []
+        pending_sep = False  # встретили пробелы/«_», которые ещё не записаны
+        for ch in filename:
+            if ch == "_" or ch.isspace():
+                pending_sep = True
+            elif ch == ".":
+                # «_» перед точкой отбрасываем, точки в начале имени — тоже
+                pending_sep = False
+                if out:
+                    out.append(ch)
+            else:
+                if pending_sep:
+                    out.append("_")
+                    pending_sep = False
+                out.append(ch)
+
+        filename = "".join(out).rstrip(".")
+        # «name...mp3» → «name.mp3»
+        head, dot, ext = filename.rpartition(".")
+        if dot and head.endswith("..") and len(ext) <= 5 and ext.isascii() and ext.isalnum():
+            filename = f"{head.rstrip('.')}.{ext}"
         return filename
 
+    @staticmethod
+    def _tag_strip(file_path: str, output_path: str) -> subprocess.CompletedProcess:
+        """Перепаковка без перекодирования: аудиопоток копируется как есть, теги и метаданные отбрасываются."""
+        command = [
+            "-i",
+            file_path,
+            "-map",
+            "0:a",
+            "-c:a",
+            "copy",
+            "-map_metadata",
+            "-1",
+            "-fflags",
+            "+bitexact",
+            "-f",
+            "mp3",
+            output_path,
+            "-y",
+        ]
+        return _run_ffmpeg(command)
+
+    @staticmethod
+    def _reencode(
+        file_path: str, output_path: str, sample_rate: int, bit_rate: int, channels: int
+    ) -> subprocess.CompletedProcess:
+        """Полное перекодирование в libmp3lame с заданными частотой, битрейтом и числом каналов."""
+        command = [
+            "-i",
+            file_path,
+            "-threads",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "-ab",
+            f"{bit_rate}k",
+            "-ac",
+            str(channels),
+            "-c:a",
+            "libmp3lame",
+            "-f",
+            "mp3",
+            output_path,
+            "-y",
+        ]
+        return _run_ffmpeg(command)
+
     @staticmethod
     def normalize_mp3_file_parallel(
         files: list, merged_folder: str, sample_rate: int = 44100, bit_rate: int = 192, channels: int = 2
     ) -> list:
         """
         Параллельно нормализует несколько аудиофайлов.
+        Файлы MPEG Layer III, у которых частота и число каналов уже совпадают с целевыми, только
+        перепаковываются через `-c:a copy` (разный битрейт MP3-фреймов склейке не мешает);
+        остальные, в том числе Layer I/II (mp3-муксер ffmpeg их не примет), перекодируются.
         Возвращает список нормализованных файлов (с сохранением исходного порядка!).
         """
         os.makedirs(merged_folder, exist_ok=True)
         normalized_files = [None] * len(files)
 
-        def normalize_one(file_path, idx):
+        def normalize_one(file_path, idx, reencode):
             output_path = os.path.join(merged_folder, f"normalized_{os.path.basename(file_path)}")
-            command = [
-                "ffmpeg",
-                "-i",
-                file_path,
-                "-ar",
-                str(sample_rate),
-                "-ab",
-                f"{bit_rate}k",
-                "-ac",
-                str(channels),
-                "-c:a",
-                "libmp3lame",
-                output_path,
-                "-y",
-            ]
-            result = subprocess.run(command, capture_output=True, check=False)
+            # Пишем во временный .part и атомарно переименовываем: оборванный ffmpeg не оставит
+            # «готовый» на вид, но обрезанный файл.
+            part_path = f"{output_path}.part"
+            if reencode:
+                result = Merge._reencode(file_path, part_path, sample_rate, bit_rate, channels)
+            else:
+                result = Merge._tag_strip(file_path, part_path)
             if result.returncode != 0:
                 app_logger.error("[normalize_mp3] Error for %s: %s", file_path, result.stderr.decode("utf-8"))
                 return idx, None
+            try:
+                os.replace(part_path, output_path)
+            except OSError as e:
+                app_logger.error("[normalize_mp3] Cannot finalize %s: %s", output_path, e)
+                return idx, None
             return idx, output_path
 
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(normalize_one, file_path, idx) for idx, file_path in enumerate(files)]
-            for future in as_completed(futures):
-                idx, result = future.result()
-                if result:
-                    normalized_files[idx] = result
-                else:
-                    app_logger.error("Normalization failed for %s", files[idx])
+        futures = []
+        for idx, file_path in enumerate(files):
+            # перепаковка упирается в диск — в IO_POOL, перекодирование — в CPU_POOL
+            reencode = Merge._get_mp3_params(file_path)[1:] != (sample_rate, channels, 3)
+            pool = CPU_POOL if reencode else IO_POOL
+            futures.append(pool.submit(normalize_one, file_path, idx, reencode))
+        for future in as_completed(futures):
+            idx, result = future.result()
+            if result:
+                normalized_files[idx] = result
+            else:
+                app_logger.error("Normalization failed for %s", files[idx])
         if any(f is None for f in normalized_files):
             app_logger.error(
                 "Normalized only %d of %d files.", sum(f is not None for f in normalized_files), len(files)
@@ -108,56 +308,98 @@ class Merge:
         return normalized_files
 
     @staticmethod
-    def merge_files_in_groups(file_list: list[str], group_size: int, output_folder: str) -> list[str]:
+    def copy_stream(src, dst, src_fd: int | None = None, bufsize: int = _COPY_BUFSIZE) -> None:
         """
-        Объединяет файлы из списка по группам заданного размера побайтово.
-        *Объединение работает корректно только с файлами, имеющими одинаковые х-ки.
-        :param file_list: Список путей к исходным файлам.
-        :param group_size: Количество файлов в группе для объединения.
-        :param output_folder: Папка, куда будут сохранены объединённые файлы.
-        :return: Список путей к объединённым файлам.
+        Дописывает в dst содержимое src с его текущей позиции до конца.
+        Если известен дескриптор src на диске — через os.sendfile (копирование внутри ядра, без буферов
+        в Python), иначе (нет sendfile, данные в памяти или ОС не умеет sendfile в dst) — через copyfileobj.
+        """
+        if src_fd is not None and hasattr(os, "sendfile"):
+            src.flush()
+            dst.flush()
+            offset = start = src.tell()
+            try:
+                while sent := os.sendfile(dst.fileno(), src_fd, offset, bufsize):
+                    offset += sent
+                return
+            except OSError:
+                if offset != start:
+                    raise
+        shutil.copyfileobj(src, dst, length=bufsize)
+
+    @staticmethod
+    def split_groups(file_list: list[str], group_size: int) -> list[list[str]]:
+        """Делит список путей на группы по group_size (последняя может быть короче)."""
+        return [file_list[start : start + group_size] for start in range(0, len(file_list), group_size)]
+
+    @staticmethod
+    def _concat_group_ffmpeg(idx: int, group: list[str], output_path: str) -> str | None:
+        """
+        Склеивает одну группу через ffmpeg concat.
+        Список файлов передаётся ffmpeg через stdin — без временного файла на диске.
+        Возвращает output_path или None, если ffmpeg завершился с ошибкой.
+        """
+        lines = []
+        for path in group:
+            escaped = path.replace("'", "'\\''")  # экранирование кавычек в синтаксисе concat
+            lines.append(f"file '{escaped}'\n")
+        concat_list = "".join(lines)
+        command = [
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-protocol_whitelist",
+            "file,pipe",
+            "-i",
+            "pipe:0",
+            "-c",
+            "copy",
+            "-map_metadata",
+            "-1",
+            "-fflags",
+            "+bitexact",
+            output_path,
+        ]
+        result = _run_ffmpeg(command, input=concat_list.encode())
+        if result.returncode != 0:
+            app_logger.error("FFmpeg error for group %d: %s", idx, result.stderr.decode())
+            return None
+        return output_path
+
+    @staticmethod
+    def iter_mp3_groups_ffmpeg(file_list, group_size, output_folder) -> Iterator[str]:
+        """
+        Как merge_mp3_groups_ffmpeg, но отдаёт пути по одному — в порядке групп, по мере готовности.
+        Все группы запускаются сразу; потребитель может обрабатывать первую, пока склеиваются остальные.
+        Если генератор закрыли раньше (клиент отключился), ещё не начатые склейки отменяются, а уже
+        запущенные дожидаются: после выхода из генератора в output_folder никто не пишет.
         """
         os.makedirs(output_folder, exist_ok=True)
-        merged_paths = []
-        for idx, start in enumerate(range(0, len(file_list), group_size), start=1):
-            group = file_list[start : start + group_size]
-            output_path = os.path.join(output_folder, f"merged_{idx}.mp3")
-            with open(output_path, "wb") as out_f:
-                for file_path in group:
-                    if not os.path.isfile(file_path):
-                        app_logger.warning("File '%s' does not exist, skipping.", file_path)
-                        continue
-                    with open(file_path, "rb") as in_f:
-                        while True:
-                            chunk = in_f.read(1024 * 1024)
-                            if not chunk:
-                                break
-                            out_f.write(chunk)
-            merged_paths.append(output_path)
-        return merged_paths
+        futures = [
+            IO_POOL.submit(Merge._concat_group_ffmpeg, idx, group, os.path.join(output_folder, f"merged_{idx}.mp3"))
+            for idx, group in enumerate(Merge.split_groups(file_list, group_size), start=1)
+        ]
+        try:
+            for future in futures:
+                path = future.result()
+                if path:
+                    yield path
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
 
     @staticmethod
     def merge_mp3_groups_ffmpeg(file_list, group_size, output_folder) -> list:
         """
-        Объединяет mp3-файлы в группы по group_size через ffmpeg concat.
+        Объединяет mp3-файлы в группы по group_size через ffmpeg concat (`-c copy`, без перекодирования).
+        Теги исходников отбрасываются, Xing/Info-заголовок пишется заново.
+        Группы обрабатываются параллельно в общем пуле, порядок результата совпадает с порядком групп.
         Возвращает список путей к полученным файлам.
         """
-        os.makedirs(output_folder, exist_ok=True)
-        merged_paths = []
-        for idx, start in enumerate(range(0, len(file_list), group_size), start=1):
-            group = file_list[start : start + group_size]
-            output_path = os.path.join(output_folder, f"merged_{idx}.mp3")
-            with tempfile.NamedTemporaryFile("w", delete=False) as f:
-                for path in group:
-                    f.write(f"file '{path}'\n")
-                list_path = f.name
-            try:
-                command = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path]
-                result = subprocess.run(command, capture_output=True, check=False)
-                if result.returncode != 0:
-                    app_logger.error("FFmpeg error for group %d: %s", idx, result.stderr.decode())
-                    continue
-                merged_paths.append(output_path)
-            finally:
-                os.remove(list_path)
-        return merged_paths
+        return list(Merge.iter_mp3_groups_ffmpeg(file_list, group_size, output_folder))
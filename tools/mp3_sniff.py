@@ -0,0 +1,29 @@
+"""Проверка MP3 по заголовкам: ID3v2-тег (если есть) и первый MPEG-фрейм, без чтения всего файла."""
+
+from tools.merge_utils import Merge
+
+
+def sniff_frame(stream) -> tuple | None:
+    """
+    Читает не больше 14 байт: 10 байт ID3v2-заголовка и 4 байта фрейма сразу после тега.
+    Зарезервированные версия/слой/битрейт/частота считаются ошибкой. Позиция stream'а восстанавливается.
+    :return: (bitrate, sample_rate, channels, layer) первого фрейма или None, если это не mp3.
+    """
+    pos = stream.tell()
+    try:
+        stream.seek(0)
+        header = stream.read(10)
+        tag_size = Merge.get_id3v2_size(header)
+        if tag_size:
+            stream.seek(tag_size)
+            frame = stream.read(4)
+        else:
+            frame = header[:4]
+    finally:
+        stream.seek(pos)
+    return Merge.parse_frame_header(frame)
+
+
+def is_mp3(stream) -> bool:
+    """True, если stream начинается с (необязательного) ID3v2-тега и валидного заголовка MPEG-фрейма."""
+    return sniff_frame(stream) is not None
@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 
+import hmac
 import secrets
 from functools import wraps
 from urllib.parse import urlparse
@@ -28,10 +29,40 @@ def check_csrf(req: Request) -> bool:
       - поле формы `csrf_token`
       - HTTP-заголовок `X-CSRF-Token`
 
-    Возвращает `True`, если токен есть и он совпадает с токеном в сессии.
+    Возвращает `True`, если токен есть и он совпадает с токеном в сессии (сравнение за константное время).
     """
     token = req.form.get("csrf_token") or req.headers.get("X-CSRF-Token")
-    return bool(token) and token == session.get("csrf_token")
+    sess_token = session.get("csrf_token")
+    if not token or not sess_token:
+        return False
+    return hmac.compare_digest(token.encode(), sess_token.encode())
+
+
+def _expected_hosts(expected: str) -> frozenset[str]:
+    """Набор допустимых host[:port]; для localhost и 127.0.0.1 — оба варианта."""
+    hosts = {expected}
+    if expected.startswith("localhost:"):
+        hosts.add(expected.replace("localhost", "127.0.0.1"))
+    if expected.startswith("127.0.0.1:"):
+        hosts.add(expected.replace("127.0.0.1", "localhost"))
+    return frozenset(hosts)
+
+
+def _origin_matches(req: Request, exp_hosts: frozenset[str]) -> bool:
+    """Сверяет `Origin`/`Referer` запроса с набором допустимых хостов."""
+    try:
+        origin = req.headers.get("Origin")
+        if origin and urlparse(origin).netloc in exp_hosts:
+            return True
+
+        referer = req.headers.get("Referer")
+        if referer and urlparse(referer).netloc in exp_hosts:
+            return True
+
+        # Нет заголовков Origin/Referer — считаем, что это same-origin
+        return not origin and not referer
+    except Exception:
+        return False
 
 
 def same_origin(req: Request, allowed_origin: str | None) -> bool:
@@ -48,24 +79,9 @@ def same_origin(req: Request, allowed_origin: str | None) -> bool:
     """
     try:
         expected = urlparse(allowed_origin).netloc if allowed_origin else req.host
-        exp_hosts = {expected}
-        if expected.startswith("localhost:"):
-            exp_hosts.add(expected.replace("localhost", "127.0.0.1"))
-        if expected.startswith("127.0.0.1:"):
-            exp_hosts.add(expected.replace("127.0.0.1", "localhost"))
-
-        origin = req.headers.get("Origin")
-        if origin and urlparse(origin).netloc in exp_hosts:
-            return True
-
-        referer = req.headers.get("Referer")
-        if referer and urlparse(referer).netloc in exp_hosts:
-            return True
-
-        # Нет заголовков Origin/Referer — считаем, что это same-origin
-        return not origin and not referer
     except Exception:
         return False
+    return _origin_matches(req, _expected_hosts(expected))
 
 
 def auth_bearer_or_same_origin_csrf(token_manager, allowed_origin: str | None) -> Callable:
@@ -82,6 +98,16 @@ def auth_bearer_or_same_origin_csrf(token_manager, allowed_origin: str | None) -
       - `403 Forbidden`, если Bearer-токен передан, но он недействителен
     """
 
+    # allowed_origin не меняется между запросами — разбираем его один раз.
+    # Если он не разбирается, запросы без Bearer-токена не пускаем (как и same_origin).
+    fixed_hosts: frozenset[str] | None = None
+    origin_broken = False
+    if allowed_origin:
+        try:
+            fixed_hosts = _expected_hosts(urlparse(allowed_origin).netloc)
+        except Exception:
+            origin_broken = True
+
     def decorator(f: Callable) -> Callable:
         @wraps(f)
         def wrapper(*args, **kwargs):
@@ -92,12 +118,16 @@ def auth_bearer_or_same_origin_csrf(token_manager, allowed_origin: str | None) -
                     return jsonify({"error": "Forbidden"}), 403
                 return f(*args, **kwargs)
 
-            if same_origin(request, allowed_origin) and check_csrf(request):
-                return f(*args, **kwargs)
+            if origin_broken:
+                return jsonify({"error": "Unauthorized"}), 401
 
-            if not same_origin(request, allowed_origin):
+            exp_hosts = fixed_hosts if fixed_hosts is not None else _expected_hosts(request.host)
+            if not _origin_matches(request, exp_hosts):
                 return jsonify({"error": "Unauthorized"}), 401
 
+            if check_csrf(request):
+                return f(*args, **kwargs)
+
             return jsonify({"error": "CSRF token missing or invalid"}), 401
 
         return wrapper
@@ -0,0 +1,130 @@
+"""Потоковый разбор multipart-тела запроса через streaming-form-data (парсер на Cython).
+
+Результат кладётся в request.form / request.files — так же, как это делает werkzeug.formparser,
+поэтому CSRF-проверка и validate_merge_request работают без изменений.
+Если пакет не установлен, STREAMING_AVAILABLE = False и тело разбирает werkzeug.
+"""
+
+from tempfile import SpooledTemporaryFile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.datastructures import Headers, MultiDict, FileStorage
+
+from logger.logger import app_logger
+
+try:
+    from streaming_form_data import StreamingFormDataParser
+    from streaming_form_data.parser import ParseFailedException
+    from streaming_form_data.targets import BaseTarget, ValueTarget
+    from streaming_form_data.validators import ValidationError, MaxSizeValidator
+except ImportError:
+    StreamingFormDataParser = None
+    BaseTarget = object
+
+STREAMING_AVAILABLE = StreamingFormDataParser is not None
+
+# Порция, которой читается тело запроса.
+READ_CHUNK = 64 * 1024
+# Как у werkzeug: до 500 КБ загрузка держится в памяти, дальше уходит во временный файл.
+SPOOL_MAX_SIZE = 500 * 1024
+# Текстовые поля формы, которые нужны /merge, и предел их длины.
+FORM_FIELDS = ("count", "csrf_token")
+MAX_FIELD_BYTES = 1024
+
+
+class _TooManyFileParts(RequestEntityTooLarge):
+    """Частей с файлами больше допустимого; отличается от 413 самого stream'а (тело больше MAX_CONTENT_LENGTH)."""
+
+
+class _UploadsTarget(BaseTarget):
+    """
+    Принимает все части поля с файлами: каждую — в свой SpooledTemporaryFile.
+    Сверх max_bytes + 1 байта данные не сохраняются: одного лишнего байта достаточно, чтобы проверка
+    размера отклонила файл, а держать на диске весь слишком большой файл незачем.
+    Частей больше max_parts не принимается: как и max_form_parts у werkzeug, следующая часть даёт 413.
+    """
+
+    def __init__(self, field_name: str, max_bytes: int, max_parts: int) -> None:
+        super().__init__()
+        self.field_name = field_name
+        self.max_bytes = max_bytes
+        self.max_parts = max_parts
+        self.uploads: list[FileStorage] = []
+        self._spool: SpooledTemporaryFile | None = None
+        self._received = 0
+
+    def on_start(self) -> None:
+        if len(self.uploads) >= self.max_parts:
+            raise _TooManyFileParts(f"Too many files in the request (> {self.max_parts}).")
+        self._spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)  # pylint: disable=consider-using-with
+        self._received = 0
+
+    def on_data_received(self, chunk: bytes) -> None:
+        room = self.max_bytes + 1 - self._received
+        if room > 0:
+            self._spool.write(chunk[:room])
+        self._received += len(chunk)
+
+    def on_finish(self) -> None:
+        self._spool.seek(0)
+        self.uploads.append(
+            FileStorage(
+                stream=self._spool,
+                filename=self.multipart_filename,
+                name=self.field_name,
+                content_type=self.multipart_content_type,
+                headers=Headers({"Content-Length": str(self._received)}),
+            )
+        )
+        # Content-Type парсер выставляет только если он есть в части — не переносим его на следующую.
+        self.multipart_content_type = None
+
+    def close(self) -> None:
+        """Закрывает временные файлы всех принятых частей."""
+        for upload in self.uploads:
+            upload.close()
+
+
+def parse_into_request(req: Request, files_field: str, max_file_bytes: int, max_files: int) -> bool:
+    """
+    Разбирает multipart-тело req потоково и заполняет req.form (поля FORM_FIELDS) и req.files.
+    Битое тело даёт пустые form/files — дальше запрос отклонят обычные проверки.
+    Частей в files_field допускается max_files + 1 (лишнюю отклонит валидация с понятной ошибкой),
+    на следующей разбор прерывается с RequestEntityTooLarge.
+    :return: False, если разбор не выполнялся (нет пакета или тело уже разобрано), иначе True.
+    """
+    if not STREAMING_AVAILABLE or "form" in req.__dict__:
+        return False
+
+    uploads = _UploadsTarget(files_field, max_file_bytes, max_files + 1)
+    fields = {name: ValueTarget(validator=MaxSizeValidator(MAX_FIELD_BYTES)) for name in FORM_FIELDS}
+    form: MultiDict = MultiDict()
+    files: MultiDict = MultiDict()
+    try:
+        parser = StreamingFormDataParser(headers=req.headers)
+        parser.register(files_field, uploads)
+        for name, target in fields.items():
+            parser.register(name, target)
+        stream = req.stream
+        while chunk := stream.read(READ_CHUNK):
+            parser.data_received(chunk)
+    except RequestEntityTooLarge as e:
+        if isinstance(e, _TooManyFileParts):
+            app_logger.warning("Multipart parsing stopped: more than %d file parts", uploads.max_parts)
+        uploads.close()
+        raise
+    except (ParseFailedException, ValidationError) as e:
+        app_logger.warning("Multipart parsing failed: %s", e)
+        uploads.close()
+    else:
+        for name, target in fields.items():
+            if target.value:
+                form[name] = target.value.decode("utf-8", "replace")
+        for upload in uploads.uploads:
+            files.add(files_field, upload)
+
+    # Тело уже прочитано: сохраняем результат туда же, куда его кладёт Request._load_form_data.
+    req.__dict__["form"] = form
+    req.__dict__["files"] = files
+    return True
@@ -1,20 +1,30 @@
 """System utilities: FFmpeg availability check."""
 
+import shutil
+import functools
 import subprocess
 
 from logger.logger import app_logger
 
 
+@functools.lru_cache(maxsize=1)
 def ffmpeg_ok() -> bool:
     """
     Проверяет, доступен ли ffmpeg в окружении.
+    Результат кэшируется: окружение процесса не меняется, а `ffmpeg -version` стоит десятки мс.
+    Сбросить кэш можно через `ffmpeg_ok.cache_clear()`.
     :return: True, если утилита установлена и возвращает код 0.
     """
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        app_logger.error("FFmpeg check failed: ffmpeg not found in PATH")
+        return False
     try:
         res = subprocess.run(
-            ["ffmpeg", "-version"],
+            [ffmpeg_path, "-version"],
             capture_output=True,
             check=False,
+            close_fds=False,
         )
         return res.returncode == 0
     except Exception as e:
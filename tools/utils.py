@@ -2,86 +2,248 @@
 Модуль с утилитами для работы с файлами: сохранение, объединение и архивирование.
 """
 
+import io
 import os
-from zipfile import ZipFile
-
-from mutagen.mp3 import MP3, HeaderNotFoundError
+import stat
+import contextlib
+from tempfile import SpooledTemporaryFile
+from collections.abc import Iterable, Iterator
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
 from logger.logger import app_logger
 
-from tools.merge_utils import Merge
+from tools.mp3_sniff import sniff_frame
+from tools.merge_utils import IO_POOL, Merge
+
+# Буфер копирования загрузок и записи в архив: mp3 уже сжаты, упираемся только в I/O.
+COPY_BUFSIZE = 4 * 1024 * 1024
+
+
+# Атрибут FileStorage, в который валидация кладёт параметры первого MPEG-фрейма.
+MP3_PARAMS_ATTR = "mp3_params"
+
+
+def _validate_one(file) -> None | tuple:
+    """
+    Проверяет один FileStorage; None если это mp3, иначе (dict, int) для Flask.
+    Разобранные параметры первого фрейма сохраняются в атрибут MP3_PARAMS_ATTR (см. upload_params).
+    """
+    try:
+        params = sniff_frame(file.stream)
+    except Exception as e:
+        app_logger.error("Unexpected error while checking MP3 file %s: %s", file.filename, e)
+        return {"error": f"File {file.filename} is not a valid MP3"}, 400
+    if params is None:
+        app_logger.error("Corrupt or invalid MP3: %s", file.filename)
+        return {"error": f"File {file.filename} is not a valid MP3"}, 400
+    setattr(file, MP3_PARAMS_ATTR, params)
+    return None
 
 
 def check_files_are_mp3(files) -> None | tuple:
     """
     Проверяет, что каждый файл из списка реально является mp3-файлом.
+    Смотрит только на ID3v2-заголовок и синхрослово первого фрейма, файл целиком не разбирается.
+    Файлы проверяются параллельно; возвращается ошибка первого (по порядку) невалидного файла.
     :param files: Список FileStorage объектов
     :return: None если всё ок, иначе (dict, int) для Flask
     """
-    for file in files:
-        file.stream.seek(0)
-        try:
-            MP3(file.stream)
-            file.stream.seek(0)
-        except HeaderNotFoundError as e:
-            app_logger.error("Corrupt or invalid MP3: %s", file.filename)
-            app_logger.error("Exception: %s", e)
-            return {"error": f"File {file.filename} is not a valid MP3"}, 400
-        except Exception as e:
-            # Иногда могут быть другие ошибки. Логируем и возвращаем 400, но не глушим всё.
-            app_logger.error("Unexpected error while checking MP3 file %s: %s", file.filename, e)
-            return {"error": f"File {file.filename} is not a valid MP3"}, 400
+    return next((err for err in IO_POOL.map(_validate_one, files) if err), None)
+
+
+def _spool_buffer(stream) -> io.BytesIO | None:
+    """
+    Буфер SpooledTemporaryFile, который ещё не сброшен на диск; для остальных stream'ов — None.
+    Единственное место, где используются внутренности SpooledTemporaryFile (_rolled/_file).
+    """
+    if isinstance(stream, SpooledTemporaryFile) and not stream._rolled:  # pylint: disable=protected-access
+        return stream._file  # pylint: disable=protected-access
     return None
 
 
+def disk_fileno(stream) -> int | None:
+    """
+    Файловый дескриптор stream'а, если данные уже лежат на диске; для буферов в памяти — None.
+    У SpooledTemporaryFile в памяти fileno() не вызывается: он сбросил бы буфер на диск.
+    """
+    if _spool_buffer(stream) is not None:
+        return None
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError):
+        return None
+
+
+def stream_size(stream) -> int:
+    """
+    Полный размер перематываемого stream'а в байтах, позиция курсора не меняется.
+    SpooledTemporaryFile в памяти — по длине буфера, файл на диске — через os.fstat,
+    остальное — через seek с возвратом на прежнюю позицию.
+    """
+    buffer = _spool_buffer(stream)
+    if buffer is not None:
+        with buffer.getbuffer() as view:
+            return view.nbytes
+    fd = disk_fileno(stream)
+    if fd is not None:
+        st = os.fstat(fd)
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size
+    pos = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(pos)
+    return size
+
+
+def _save_upload(stream, path: str) -> None:
+    """
+    Копирует содержимое загруженного файла (с текущей позиции) в path.
+    Если stream — файл на диске, копирование идёт через os.sendfile внутри ядра,
+    иначе — через copyfileobj с большим буфером.
+    """
+    with open(path, "wb") as dst:
+        Merge.copy_stream(stream, dst, disk_fileno(stream), COPY_BUFSIZE)
+
+
+def upload_params(files: list) -> list[tuple] | None:
+    """
+    Параметры (bitrate, sample_rate, channels, layer), прочитанные check_files_are_mp3 при валидации.
+    None, если хотя бы для одного файла их нет — тогда параметры читаются из сохранённых файлов.
+    """
+    params = [getattr(f, MP3_PARAMS_ATTR, None) for f in files]
+    return None if any(p is None for p in params) else params
+
+
 def saving_files(upload_folder: str, files: list) -> list:
     """
     Сохраняет загруженные файлы в указанной директории с безопасными именами.
+    Файлы пишутся параллельно в общем пуле; порядок результата совпадает с порядком files.
+    Совпавшие после нормализации имена получают префикс с номером файла.
     """
-    file_paths = []
+    used: set[str] = set()
+    jobs = []
     for idx, file in enumerate(files, start=1):
         safe_name = Merge.normalize_filename(file.filename) or f"file_{idx}.mp3"
-        path = os.path.join(upload_folder, safe_name)
+        while safe_name in used:
+            safe_name = f"{idx}_{safe_name}"
+        used.add(safe_name)
+        jobs.append((file, os.path.join(upload_folder, safe_name)))
+
+    def save_one(job) -> str:
+        file, path = job
         try:
-            file.save(path)
-            file_paths.append(path)
+            _save_upload(file.stream, path)
         except Exception as e:
             app_logger.error("Ошибка при сохранении %s: %s", file.filename, e)
             raise RuntimeError(f"Ошибка при сохранении {file.filename}: {e}") from e
-    return file_paths
+        return path
+
+    return list(IO_POOL.map(save_one, jobs))
+
+
+def iter_smart_merge(
+    file_paths: list, files_count: int, merged_folder: str, params: list[tuple] | None = None
+) -> Iterator[str]:
+    """
+    Интеллектуальное объединение MP3 через ffmpeg concat с `-c copy` (без перекодирования):
+    Если параметры одинаковые — склеиваем исходные файлы сразу.
+    Если разные — сначала нормализация через ffmpeg.
+    Пути к готовым файлам отдаются по одному, в порядке групп, по мере готовности.
+    Если хотя бы один файл не удалось нормализовать — RuntimeError: группу без него не склеиваем.
+    :param params: Уже известные параметры файлов (см. upload_params) — тогда файлы повторно не читаются.
+    """
+    if params is not None and len(params) == len(file_paths):
+        same_params = len(set(params)) <= 1
+    else:
+        same_params = Merge.all_params_equal(file_paths)
+    if not same_params:
+        normalized = Merge.normalize_mp3_file_parallel(file_paths, merged_folder)
+        failed = [os.path.basename(src) for src, out in zip(file_paths, normalized, strict=True) if out is None]
+        if failed:
+            raise RuntimeError(f"Не удалось нормализовать файлы: {', '.join(failed)}")
+        file_paths = normalized
+    yield from Merge.iter_mp3_groups_ffmpeg(file_paths, files_count, merged_folder)
+
+
+def smart_merge_mp3_files(
+    file_paths: list, files_count: int, merged_folder: str, params: list[tuple] | None = None
+) -> list[str]:
+    """
+    Интеллектуальное объединение MP3 (см. iter_smart_merge).
+    :return: Список путей к объединённым файлам.
+    """
+    return list(iter_smart_merge(file_paths, files_count, merged_folder, params))
+
+
+class _ChunkSink(io.RawIOBase):
+    """Неперематываемый приёмник для ZipFile: копит записанные байты и отдаёт их порциями."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> list[bytes]:
+        """Забирает накопленные байты."""
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _fadvise(fd: int, advice: str) -> None:
+    """Подсказка ядру о характере чтения файла; на платформах без posix_fadvise — ничего не делает."""
+    fadvise = getattr(os, "posix_fadvise", None)
+    if fadvise is None:
+        return
+    with contextlib.suppress(OSError):
+        fadvise(fd, 0, 0, getattr(os, advice))
 
 
-def smart_merge_mp3_files(file_paths: list, files_count: int, merged_folder: str) -> list[str]:
+def _write_zip_member(zipf: ZipFile, path: str) -> Iterator[int]:
     """
-    Интеллектуальное объединение MP3:
-    Если параметры одинаковые — просто байтовый merge (молниеносно).
-    Если разные — нормализация через ffmpeg, потом merge.
+    Потоково пишет файл в архив без сжатия.
+    ZipInfo.from_file сохраняет mtime и права исходника; данные копируются большим буфером.
+    Генератор: после каждой записанной порции отдаёт её размер — потоковый вызывающий
+    успевает забрать байты архива, не дожидаясь конца файла.
     """
-    if Merge.all_params_equal(file_paths):
-        return Merge.merge_files_in_groups(file_paths, files_count, merged_folder)
-    normalized_files = Merge.normalize_mp3_file_parallel(file_paths, merged_folder)
-    return Merge.merge_mp3_groups_ffmpeg(normalized_files, files_count, merged_folder)
+    zinfo = ZipInfo.from_file(path, arcname=os.path.basename(path))
+    zinfo.compress_type = ZIP_STORED
+    with zipf.open(zinfo, "w", force_zip64=True) as dst, open(path, "rb", buffering=0) as src:
+        fd = src.fileno()
+        _fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+        # Порция bytes из read() уходит в архив как есть: bytes(b) в _ChunkSink её не копирует.
+        while chunk := src.read(COPY_BUFSIZE):
+            dst.write(chunk)
+            yield len(chunk)
+        # файл дочитан и больше не нужен — не держим его страницы в page cache
+        _fadvise(fd, "POSIX_FADV_DONTNEED")
 
 
-def create_zip(merged_folder: str, merged_files: list) -> str:
+def stream_zip(merged_files: Iterable[str], remove_after: bool = False) -> Iterator[bytes]:
     """
-    Создаёт ZIP-архив с объединёнными файлами.
-    Если какой-то файл отсутствует, пишет warning в лог.
-    Если список файлов пуст — кидает RuntimeError.
-    :param merged_folder: Директория, в которой будет создан архив.
-    :param merged_files: Список файлов для добавления в архив.
-    :return: Путь к созданному ZIP-файлу.
+    Отдаёт ZIP-архив (ZIP_STORED) порциями, не создавая его на диске.
+    merged_files может быть ленивым (например, iter_smart_merge): каждая группа уходит клиенту,
+    как только готова, пока остальные ещё склеиваются.
+    Если remove_after — файл удаляется сразу после того, как попал в архив.
+    Если не добавлено ни одного файла — кидает RuntimeError до отдачи первого байта.
     """
-    archive_path = os.path.join(merged_folder, "merged_files.zip")
-    if not merged_files:
-        msg = "Нет файлов для архивации."
-        app_logger.error(msg)
-        raise RuntimeError(msg)
-    with ZipFile(archive_path, "w") as zipf:
+    sink = _ChunkSink()
+    added = 0
+    with ZipFile(sink, "w", compression=ZIP_STORED, allowZip64=True) as zipf:
         for merged_file in merged_files:
-            if os.path.isfile(merged_file):
-                zipf.write(str(merged_file), os.path.basename(merged_file))
-            else:
-                app_logger.warning("Файл %s не найден, не добавлен в архив.", merged_file)
-    app_logger.info("Создан архив: %s", archive_path)
-    return archive_path
+            for _ in _write_zip_member(zipf, merged_file):
+                yield from sink.drain()
+            yield from sink.drain()
+            if remove_after:
+                os.remove(merged_file)
+            added += 1
+        if not added:
+            msg = "Нет файлов для архивации."
+            app_logger.error(msg)
+            raise RuntimeError(msg)
+    yield from sink.drain()
@@ -2,18 +2,35 @@
 
 Модуль разбивает проверки на мелкие функции:
 - _check_content_type: корректность Content-Type;
+- _check_content_length: заведомо слишком большое тело (по заголовку Content-Length);
 - _check_files_and_count: наличие файлов и валидность параметра count;
-- _check_sizes: ограничение на размер каждого файла;
+- _scan_files: расширение, пустые и слишком большие файлы за один проход;
 - validate_merge_request: координирует все проверки и формирует единый результат.
 """
 
-import os
+import json
+from operator import attrgetter
 from typing import Any, NamedTuple
 from collections.abc import Iterable
 
-from flask import Request, Response, jsonify
+from flask import Request, Response
 from werkzeug.datastructures import FileStorage
 
+from tools.utils import stream_size, check_files_are_mp3
+
+# Неизменные тексты ошибок — создаются один раз при импорте модуля.
+_ERR_CONTENT_TYPE = "Content-Type must be multipart/form-data"
+_ERR_NO_FILES = "No files provided"
+_ERR_COUNT_REQUIRED = "Parameter 'count' is required and must be integer"
+_ERR_COUNT_NOT_POSITIVE = "Parameter 'count' must be > 0"
+_ERR_COUNT_TOO_BIG = "Parameter 'count' must be <= number of files"
+_ERR_EXTENSION = "File must have .mp3 extension"
+_ERR_FFMPEG = "FFmpeg is not available in runtime"
+_ERR_REQUEST_TOO_LARGE = "Request too large"
+
+# Запас на multipart-разметку (границы, заголовки частей, текстовые поля) сверх самих файлов.
+_MULTIPART_OVERHEAD = 64 * 1024
+
 
 class ValidationResult(NamedTuple):
     """Результат валидации запроса на мердж.
@@ -21,7 +38,7 @@ class ValidationResult(NamedTuple):
     Attributes:
         files: Список файлов (FileStorage) при успешной валидации, иначе None.
         count: Величина группировки файлов при успешной валидации, иначе None.
-        error_response: Готовый Flask-ответ с ошибкой (jsonify), если валидация не прошла.
+        error_response: Готовый Flask-ответ с ошибкой ({"error": ...}), если валидация не прошла.
         status_code: HTTP-код для error_response или None при успехе.
     """
 
@@ -31,20 +48,52 @@ class ValidationResult(NamedTuple):
     status_code: int | None
 
 
+def _dump_error(msg: str) -> bytes:
+    """Тело JSON-ответа с ошибкой в том же виде, что у jsonify."""
+    return (json.dumps({"error": msg}, separators=(",", ":")) + "\n").encode()
+
+
+# Постоянные тексты ошибок сериализуются один раз при импорте.
+_STATIC_ERROR_BODIES = {
+    msg: _dump_error(msg)
+    for msg in (
+        _ERR_CONTENT_TYPE,
+        _ERR_NO_FILES,
+        _ERR_COUNT_REQUIRED,
+        _ERR_COUNT_NOT_POSITIVE,
+        _ERR_COUNT_TOO_BIG,
+        _ERR_EXTENSION,
+        _ERR_FFMPEG,
+        _ERR_REQUEST_TOO_LARGE,
+    )
+}
+
+
+def _error_body(msg: str) -> bytes:
+    """Готовое тело для постоянного текста ошибки; тексты с именем файла сериализуются на месте."""
+    body = _STATIC_ERROR_BODIES.get(msg)
+    return body if body is not None else _dump_error(msg)
+
+
+def _error_response(msg: str, code: int) -> Response:
+    """
+    JSON-ответ {"error": msg} с кодом code.
+    Response создаётся заново на каждый запрос: Flask и Flask-Compress меняют его заголовки и статус.
+    """
+    return Response(_error_body(msg), status=code, mimetype="application/json")
+
+
+# Имя части multipart: attrgetter вызывается на уровне C, без getattr с дефолтом на каждый файл.
+_filename = attrgetter("filename")
+
+
 def _filter_empty_files(files: Iterable[Any]) -> list[FileStorage]:
     """
     Оставляем только реальные файлы с непустым именем.
     Содержимое (длина) здесь не проверяем – это делается
     дальше в validate_merge_request в «Size check».
     """
-    filtered: list[FileStorage] = []
-    for f in files:
-        if not f:
-            continue
-        name = getattr(f, "filename", "").strip()
-        if name:
-            filtered.append(f)
-    return filtered
+    return [f for f in files if f and _filename(f).strip()]
 
 
 def _check_content_type(req: Request) -> tuple[str | None, int]:
@@ -53,10 +102,35 @@ def _check_content_type(req: Request) -> tuple[str | None, int]:
     :return: (сообщение_об_ошибке | None, http_код). Если всё ок — (None, 400).
     """
     if req.mimetype != "multipart/form-data":
-        return "Content-Type must be multipart/form-data", 415
+        return _ERR_CONTENT_TYPE, 415
     return None, 400
 
 
+def max_request_bytes(max_files: int, max_per_file_mb: int) -> int:
+    """Наибольший допустимый размер тела запроса: все файлы по максимуму плюс multipart-разметка."""
+    return max_files * (max_per_file_mb << 20) + _MULTIPART_OVERHEAD
+
+
+def _check_content_length(req: Request, max_bytes: int) -> tuple[str, int] | tuple[None, None]:
+    """Отклоняет запрос по заголовку Content-Length, не читая тело.
+
+    :return: (сообщение_об_ошибке, 413), если тело заведомо больше max_bytes, иначе (None, None).
+    """
+    if req.content_length and req.content_length > max_bytes:
+        return _ERR_REQUEST_TOO_LARGE, 413
+    return None, None
+
+
+def _parse_count(raw: str | None) -> int | None:
+    """Параметр count из формы как int; None, если его нет или это не целое число."""
+    if raw is None:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+
 def _check_files_and_count(files: list[Any], count: int | None, max_files: int) -> tuple[str | None, int]:
     """Проверяет список файлов и параметр count.
 
@@ -66,59 +140,69 @@ def _check_files_and_count(files: list[Any], count: int | None, max_files: int)
       - лимит на количество файлов;
       - count <= len(files).
 
+    Корректный запрос проходит одним сцепленным сравнением; какая именно проверка не прошла,
+    выясняется только на (редком) пути ошибки — в том же порядке, что и в списке выше.
+
     :return: (сообщение_об_ошибке | None, http_код). Если всё ок — (None, 400).
     """
-    if not files:
-        return "No files provided", 400
+    n = len(files)
+    if not n:
+        return _ERR_NO_FILES, 400
     if count is None:
-        return "Parameter 'count' is required and must be integer", 400
+        return _ERR_COUNT_REQUIRED, 400
+    if 0 < count <= n <= max_files:
+        return None, 400
     if count <= 0:
-        return "Parameter 'count' must be > 0", 400
-    if len(files) > max_files:
+        return _ERR_COUNT_NOT_POSITIVE, 400
+    if n > max_files:
         return f"Too many files (>{max_files}). Reduce the number of files.", 400
-    if count > len(files):
-        return "Parameter 'count' must be <= number of files", 400
-    return None, 400
+    return _ERR_COUNT_TOO_BIG, 400
 
 
-def _check_sizes(files: list[Any], max_bytes: int) -> tuple[str, int] | tuple[None, None]:
-    """Проверяет, что каждый файл не превышает заданный размер.
-
-    :param files: Список объектов FileStorage.
-    :param max_bytes: Максимально допустимый размер одного файла в байтах.
-    :return: (сообщение_об_ошибке | None, http_код). Если всё ок — (None, 400).
-    """
-    too_large = next((f for f in files if _file_size(f) > max_bytes), None)
-    if too_large:
-        return f"File '{too_large.filename}' is too large (> {max_bytes // (1024 * 1024)} MB)", 400
-    return None, None
+# Ключ в __dict__ FileStorage, под которым запоминается измеренный размер.
+_SIZE_KEY = "_cached_size"
 
 
 def _file_size(f: FileStorage) -> int:
     """Возвращает размер файла в байтах.
-    - Если `content_length` указан — пользуемся им.
-    - Иначе аккуратно измеряем длину stream'а (с сохранением позиции курсора)."""
-    if getattr(f, "content_length", None):
-        return int(f.content_length)
-
-    pos = f.stream.tell()
-    f.stream.seek(0, os.SEEK_END)
-    size = f.stream.tell()
-    f.stream.seek(pos)
+    - Если stream перематывается — измеряем его длину (stream_size, без сдвига курсора):
+      content_length части multipart присылает клиент, и он может быть не указан или занижен.
+    - Иначе пользуемся `content_length`.
+    Результат запоминается на самом объекте: повторные проверки не трогают stream."""
+    cached = f.__dict__.get(_SIZE_KEY)
+    if cached is not None:
+        return cached
+
+    stream = getattr(f, "stream", None)
+    if stream is None or not stream.seekable():
+        size = int(getattr(f, "content_length", None) or 0)
+    else:
+        size = stream_size(stream)
+    f.__dict__[_SIZE_KEY] = size
     return size
 
 
-def _check_mp3_extension_and_size(f: FileStorage, max_bytes: int) -> str | None:
-    """Проверка файлов"""
-    if not f.filename.lower().endswith(".mp3"):
-        return "File must have .mp3 extension"
+def _scan_files(files: list[FileStorage], max_bytes: int) -> tuple[str, int] | tuple[None, None]:
+    """Проверяет расширение .mp3, пустые и слишком большие файлы.
 
-    size = _file_size(f)
-    if size == 0:
-        return f"File {f.filename} is empty"
-    if size > max_bytes:
-        return f"File {f.filename} is too large (> {max_bytes // (1024 * 1024)} MB)"
-    return None
+    Имена и размеры собираются один раз в два параллельных списка, проверки идут по ним целиком;
+    номер виновного файла ищется только при ошибке. Размеры не измеряются, если не подошло расширение.
+    :return: (сообщение_об_ошибке | None, http_код). Если всё ок — (None, None).
+    """
+    if not files:
+        return None, None
+    names = [f.filename for f in files]
+    # Понижаем регистр только у последних 4 символов, а не у всего имени.
+    if not all(name[-4:].lower() == ".mp3" for name in names):
+        return _ERR_EXTENSION, 400
+
+    sizes = [_file_size(f) for f in files]
+    if min(sizes) == 0:
+        return f"File {names[sizes.index(0)]} is empty", 400
+    if max(sizes) > max_bytes:
+        idx = next(i for i, size in enumerate(sizes) if size > max_bytes)
+        return f"File {names[idx]} is too large (> {max_bytes >> 20} MB)", 400
+    return None, None
 
 
 def validate_merge_request(
@@ -126,9 +210,12 @@ def validate_merge_request(
     max_files: int,
     max_per_file_mb: int,
     ffmpeg_available: bool,
-    check_files_are_mp3_fn,
+    check_files_are_mp3_fn=check_files_are_mp3,
 ) -> ValidationResult:
-    """Возвращает ValidationResult с error_response=None, если ошибок нет."""
+    """
+    Возвращает ValidationResult с error_response=None, если ошибок нет.
+    По умолчанию mp3-валидность проверяется только по заголовкам (tools.mp3_sniff), без чтения файлов целиком.
+    """
 
     files: list[Any] | None = None
     count: int | None = None
@@ -139,38 +226,35 @@ def validate_merge_request(
     if error is None:
         error, code = _check_content_type(req)
 
-    # 2) files + count
+    # 1.1) Content-Length — по заголовку, до разбора тела
+    if error is None:
+        error, code = _check_content_length(req, max_request_bytes(max_files, max_per_file_mb))
+
+    # 2) FFmpeg — бесплатная проверка, до обращения к req.files (оно запускает разбор multipart-тела)
+    if error is None and not ffmpeg_available:
+        error, code = _ERR_FFMPEG, 500
+
+    # 3) files + count
     if error is None:
         raw = req.files.getlist("files")
         files = _filter_empty_files(raw)
         if not files:
-            error, code = "No files provided", 400
+            error, code = _ERR_NO_FILES, 400
         else:
-            count = req.form.get("count", type=int)
+            count = _parse_count(req.form.get("count"))
             error, code = _check_files_and_count(files, count, max_files)
 
-    # 3) FFmpeg
-    if error is None and not ffmpeg_available:
-        error, code = "FFmpeg is not available in runtime", 500
-
     # 4) mp3-валидность
     if error is None:
         mp3_err = check_files_are_mp3_fn(files)  # type: ignore[arg-type]
         if mp3_err:
             error, code = mp3_err[0]["error"], mp3_err[1]
 
-    # 5) размеры и расширение
+    # 5) расширение и размер
     if error is None:
-        max_bytes = max_per_file_mb * 1024 * 1024
-        for f in files:  # type: ignore[arg-type]
-            err = _check_mp3_extension_and_size(f, max_bytes)
-            if err:
-                error, code = err, 400
-                break
-        if error is None:
-            error, code = _check_sizes(files, max_bytes)  # type: ignore[arg-type]
+        error, code = _scan_files(files, max_per_file_mb << 20)  # type: ignore[arg-type]
 
     if error is not None:
-        return ValidationResult(None, None, jsonify({"error": error}), code)  # type: ignore[arg-type]
+        return ValidationResult(None, None, _error_response(error, code), code)  # type: ignore[arg-type]
 
     return ValidationResult(files, count, None, None)  # type: ignore[arg-type]